@@ -1,6 +1,4 @@
 import numpy as np
-from scipy.linalg import cholesky
-from filterpy.common import pretty_str
 
 
 class MerweScaledSigmaPoints(object):
@@ -31,11 +29,13 @@ class MerweScaledSigmaPoints(object):
         Secondary scaling parameter usually set to 0 according to [4],
         or to 3-n according to [5].
 
-    sqrt_method : function(ndarray), default=scipy.linalg.cholesky
+    sqrt_method : function(ndarray), default=robust Cholesky
         Defines how we compute the square root of a matrix, which has
         no unique answer. Cholesky is the default choice due to its
-        speed. Typically your alternative choice will be
-        scipy.linalg.sqrtm. Different choices affect how the sigma points
+        speed. The default retries a failed Cholesky decomposition with
+        growing diagonal jitter and finally falls back to an
+        eigendecomposition; see `fallbacks`. Typically your alternative
+        choice will be scipy.linalg.sqrtm. Different choices affect how the sigma points
         are arranged relative to the eigenvectors of the covariance matrix.
         Usually this will not matter to you; if so the default cholesky()
         yields maximal performance. As of van der Merwe's dissertation of
@@ -45,13 +45,14 @@ class MerweScaledSigmaPoints(object):
         If your method returns a triangular matrix it must be upper
         triangular. Do not use numpy.linalg.cholesky - for historical
         reasons it returns a lower triangular matrix. The SciPy version
-        does the right thing.
+        does the right thing. A custom method is applied to one matrix
+        at a time.
 
     subtract : callable (x, y), optional
         Function that computes the difference between x and y.
         You will have to supply this if your state variable cannot support
         subtraction, such as angles (359-1 degreees is 2, not 358). x and y
-        are state vectors, not scalars.
+        are arrays of state vectors that must broadcast against each other.
 
     Attributes
     ----------
@@ -62,6 +63,11 @@ class MerweScaledSigmaPoints(object):
     Wc : np.array
         weight for each sigma point for the covariance
 
+    fallbacks : dict
+        Counts how often the default square root needed 'jitter' or an
+        'eigen' decomposition, next to the number of plain 'cholesky'
+        successes.
+
     Examples
     --------
 
@@ -85,7 +91,7 @@ class MerweScaledSigmaPoints(object):
         self.beta = beta
         self.kappa = kappa
         if sqrt_method is None:
-            self.sqrt = cholesky
+            self.sqrt = self._robust_sqrt
         else:
             self.sqrt = sqrt_method
 
@@ -94,6 +100,8 @@ class MerweScaledSigmaPoints(object):
         else:
             self.subtract = subtract
 
+        self.fallbacks = {'cholesky': 0, 'jitter': 0, 'eigen': 0}
+
         self._compute_weights()
 
     def num_sigmas(self):
@@ -109,34 +117,38 @@ class MerweScaledSigmaPoints(object):
         sigma_points (5, 9, 2) # mean 5, covariance 9
         sigma_points ([5, 2], 9*eye(2), 2) # means 5 and 2, covariance 9I
 
+        A batch of filters can be handled at once by stacking B means
+        into a (B, n) array and B covariances into a (B, n, n) array.
+
         Parameters
         ----------
 
-        x : An array-like object of the means of length n
+        x : An array-like object of the means of length n, or (B, n)
             Can be a scalar if 1D.
             examples: 1, [1,2], np.array([1,2])
 
         P : scalar, or np.array
            Covariance of the filter. If scalar, is treated as eye(n)*P.
+           Stacked covariances have shape (B, n, n).
 
         Returns
         -------
 
-        sigmas : np.array, of size (n, 2n+1)
-            Two dimensional array of sigma points. Each column contains all of
+        sigmas : np.array, of size (2n+1, n), or (B, 2n+1, n)
+            Array of sigma points. Each column contains all of
             the sigmas for one dimension in the problem space.
 
             Ordered by Xi_0, Xi_{1..n}, Xi_{n+1..2n}
         """
 
-        if self.n != np.size(x):
-            raise ValueError("expected size(x) {}, but size is {}".format(
-                self.n, np.size(x)))
-
         n = self.n
+        x = np.asarray(x, dtype=float)
+        if x.ndim == 0:
+            x = x.reshape(1)
 
-        if np.isscalar(x):
-            x = np.asarray([x])
+        if x.shape[-1] != n:
+            raise ValueError("expected size(x) {}, but size is {}".format(
+                self.n, x.shape[-1]))
 
         if np.isscalar(P):
             P = np.eye(n)*P
@@ -144,17 +156,82 @@ class MerweScaledSigmaPoints(object):
             P = np.atleast_2d(P)
 
         lambda_ = self.alpha**2 * (n + self.kappa) - n
-        U = self.sqrt((lambda_ + n)*P)
+        scaled_P = (lambda_ + n)*P
+        if scaled_P.ndim == 2 or self.sqrt == self._robust_sqrt:
+            U = self.sqrt(scaled_P)
+        else:
+            U = np.array([self.sqrt(P_i) for P_i in scaled_P])
+
+        return self._spread(x, U)
+
+    def sigma_points_from_sqrt(self, x, S):
+        """ Computes the sigma points from the mean and a square root of
+        the covariance, as kept by a square root filter. No matrix square
+        root is taken.
+
+        Parameters
+        ----------
+
+        x : np.array
+            The mean, of length n, or (B, n)
+
+        S : np.array
+            Square root of the covariance with S.T @ S = P, such as the
+            upper triangular Cholesky factor. (B, n, n) if batched.
+
+        Returns
+        -------
+
+        sigmas : np.array, of size (2n+1, n), or (B, 2n+1, n)
+            Ordered as for sigma_points
+        """
+        n = self.n
+        lambda_ = self.alpha**2 * (n + self.kappa) - n
+        return self._spread(np.asarray(x, dtype=float), np.sqrt(lambda_ + n)*S)
+
+    def _spread(self, x, U):
+        """ Places the sigma points at x and x +- the rows of U """
+        n = self.n
+        x = x[..., np.newaxis, :]
 
-        sigmas = np.zeros((2*n+1, n))
-        sigmas[0] = x
-        for k in range(n):
-            # pylint: disable=bad-whitespace
-            sigmas[k+1] = self.subtract(x, -U[k])
-            sigmas[n+k+1] = self.subtract(x, U[k])
+        sigmas = np.empty(np.broadcast(x[..., 0, 0], U[..., 0, 0]).shape + (2*n+1, n))
+        sigmas[..., :1, :] = x
+        sigmas[..., 1:n+1, :] = self.subtract(x, -U)
+        sigmas[..., n+1:, :] = self.subtract(x, U)
 
         return sigmas
 
+    def _robust_sqrt(self, P):
+        """ Upper triangular Cholesky factor of P, or of a stack of P.
+
+        A matrix that is not positive definite is retried with diagonal
+        jitter that grows tenfold each time, starting at 1e-12 of its
+        mean diagonal. If that fails too, a square root is built from an
+        eigendecomposition with negative eigenvalues clipped to zero.
+        """
+        P = np.asarray(P, dtype=float)
+        try:
+            U = np.swapaxes(np.linalg.cholesky(P), -1, -2)
+            self.fallbacks['cholesky'] += P.size // (self.n * self.n)
+            return U
+        except np.linalg.LinAlgError:
+            if P.ndim > 2:
+                return np.array([self._robust_sqrt(P_i) for P_i in P])
+
+        scale = max(np.trace(P) / self.n, np.finfo(float).tiny)
+        identity = np.eye(self.n)
+        for jitter in 10.0**np.arange(-12, -3):
+            try:
+                U = np.linalg.cholesky(P + jitter*scale*identity).T
+                self.fallbacks['jitter'] += 1
+                return U
+            except np.linalg.LinAlgError:
+                pass
+
+        self.fallbacks['eigen'] += 1
+        w, V = np.linalg.eigh((P + P.T) / 2)
+        return np.sqrt(np.clip(w, 0, None))[:, np.newaxis] * V.T
+
     def _compute_weights(self):
         """ Computes the weights for the scaled unscented Kalman filter.
 
@@ -169,12 +246,12 @@ class MerweScaledSigmaPoints(object):
 
         return '\n'.join([
             'MerweScaledSigmaPoints object',
-            pretty_str('n', self.n),
-            pretty_str('alpha', self.alpha),
-            pretty_str('beta', self.beta),
-            pretty_str('kappa', self.kappa),
-            pretty_str('Wm', self.Wm),
-            pretty_str('Wc', self.Wc),
-            pretty_str('subtract', self.subtract),
-            pretty_str('sqrt', self.sqrt)
+            '{} = {}'.format('n', self.n),
+            '{} = {}'.format('alpha', self.alpha),
+            '{} = {}'.format('beta', self.beta),
+            '{} = {}'.format('kappa', self.kappa),
+            '{} = {}'.format('Wm', self.Wm),
+            '{} = {}'.format('Wc', self.Wc),
+            '{} = {}'.format('subtract', self.subtract),
+            '{} = {}'.format('sqrt', self.sqrt)
             ])
@@ -1,5 +1,64 @@
 # Contains code for the system model
+import collections
+import math
 import numpy
+import scipy.integrate
+import scipy.linalg
+import history
+
+
+PARAMETER_NAMES = ('alpha', 'PO', 'gamma', 'theta', 'beta', 'delta',
+                   'k_first_increase', 'k_second_increase', 'k_decrease')
+"""The names of the kinetic parameters, in the order of the parameter vector taken by :func:`model_constants`"""
+
+ModelConstants = collections.namedtuple('ModelConstants', PARAMETER_NAMES + ('rate_matrix_inv',))
+ModelConstants.__doc__ = """Immutable constants shared by all evaluations of the model equations.
+Create instances with :func:`model_constants`.
+The kinetic parameters, `constants[:-1]`, are the parameter vector"""
+
+
+def model_constants(alpha=0.1, PO=0.1, gamma=1.8, theta=0.1, beta=0.1, delta=0.2,
+                    k_first_increase=0.6/46/25*4, k_second_increase=2/46/120*3.2, k_decrease=0.6/46/40*3):
+    """Builds the constants used by the model equations.
+    The inverse of the rate matrix is calculated here so that it is only calculated once.
+    Each constant may also be an array with one value per state in :func:`batch_DEs`,
+    e.g. to simulate parameter variants with :class:`EnsembleModel`.
+    A parameter vector ordered as :data:`PARAMETER_NAMES` can be passed with `model_constants(*vector)`
+
+    Parameters
+    ----------
+    alpha, PO, gamma, theta, beta, delta : float or array_like, optional
+        Kinetic constants of the model
+
+    k_first_increase, k_second_increase, k_decrease : float or array_like, optional
+        Rate constants of the enzymes.
+        Ny drives the first increase at 1.8 times its constant, the second increase is constant
+        and Nz drives the decrease at a third of its constant
+
+    Returns
+    -------
+    constants : ModelConstants
+        The constants with a read-only stack of inverse rate matrices of shape (1, 5, 5),
+        or (N, 5, 5) if `gamma` or `beta` has N values
+    """
+    gamma, beta = numpy.broadcast_arrays(numpy.asarray(gamma, dtype=float), numpy.asarray(beta, dtype=float))
+    rate_matrix = numpy.empty(gamma.shape + (5, 5))
+    rate_matrix[...] = [[1, 0, 0, 0, 0],
+                        [0, 0, 0, 1, 0],
+                        [0, 0, 0, 0, 1],
+                        [-6, 4, 7/3, 2, 0],
+                        [0, 12, -1, 0, 0]]
+    rate_matrix[..., 3, 4] = -gamma
+    rate_matrix[..., 4, 4] = beta
+    rate_matrix_inv = numpy.linalg.inv(rate_matrix).reshape(-1, 5, 5)
+    rate_matrix_inv.flags.writeable = False
+    if gamma.ndim == 0:
+        gamma, beta = float(gamma), float(beta)
+    return ModelConstants(alpha, PO, gamma, theta, beta, delta,
+                          k_first_increase, k_second_increase, k_decrease, rate_matrix_inv)
+
+
+CONSTANTS = model_constants()
 
 
 class Model:
@@ -18,9 +77,21 @@ class Model:
         Defaults to zero
 
     pH_calculations : bool, optional
-        If `True` then pH calculations are made.
+        If `True` then the pH is included in :meth:`get_data`.
+        It is calculated when the data is requested, not on every step.
         Defaults to `False`
 
+    integrator : string, optional
+        The method used to integrate the model in :meth:`step`.
+        `'euler'` takes a single forward Euler step.
+        Any method accepted by `scipy.integrate.solve_ivp` (e.g. `'RK45'`, `'LSODA'`)
+        integrates with error control and locates the enzyme depletion events.
+        Defaults to `'euler'`
+
+    rtol, atol : float, optional
+        Relative and absolute tolerances for the adaptive integrators.
+        Defaults to 1e-6 and 1e-9
+
     Attributes
     -----------
     X : array_like
@@ -33,27 +104,38 @@ class Model:
         Initial time
 
     pH_calculations : bool
-        If `True` then pH calculations are made
+        If `True` then the pH is included in :meth:`get_data`
+
+    integrator : string
+        The method used to integrate the model
+
+    rtol, atol : float
+        Relative and absolute tolerances for the adaptive integrators
 
-    rate_matrix_inv : 2d array_like
-        The inverse of the rate matrix.
-        Placed here so that it is only calculated once
+    nfev : int
+        The number of right hand side evaluations made by the adaptive integrators
+
+    constants : ModelConstants
+        The constants used by the model equations.
+        Defaults to the shared :data:`CONSTANTS`
     """
-    def __init__(self, X0, inputs, t=0, pH_calculations=False):
-        self.X = numpy.array(X0)
+    def __init__(self, X0, inputs, t=0, pH_calculations=False, integrator='euler', rtol=1e-6, atol=1e-9):
+        self.X = numpy.array(X0, dtype=float)
         self.inputs = inputs
         self.t = t
         self.pH_calculations = pH_calculations
+        self.integrator = integrator
+        self.rtol = rtol
+        self.atol = atol
+        self.nfev = 0
+        self._segments = []
 
-        self._Xs = [self.outputs()]
+        self.constants = CONSTANTS
+        self._pH = None
 
-        alpha, PO, gamma, theta, beta = 0.1, 0.1, 1.8, 0.1, 0.1
-        rate_matrix = numpy.array([[1, 0, 0, 0, 0],
-                                   [0, 0, 0, 1, 0],
-                                   [0, 0, 0, 0, 1],
-                                   [-6, 4, 7/3, 2, -gamma],
-                                   [0, 12, -1, 0, beta]])
-        self.rate_matrix_inv = numpy.linalg.inv(rate_matrix)
+        self._history = history.History([('X', self.X.shape), ('pH', ())])
+        self._history.append(self.t, X=self.X)
+        self._n_pH = 0
 
     def DEs(self, t):
         """Contains the differential and algebraic equations for the system model.
@@ -76,54 +158,28 @@ class Model:
         dX : array_like
             The differential changes to the state variables
         """
-        Ng, Nx, Nfa, Ne, Nco, No, Nn, Na, Nb, Nz, Ny, V, Vg, T = [max(0, N) for N in self.X]
-        Fg_in, Cg_in, Fco_in, Cco_in, Fo_in, Co_in, \
-            Fg_out, Cn_in, Fn_in, Fb_in, Cb_in, Fm_in, Fout, Tamb, Q = self.inputs(t)
-
-        alpha, PO, gamma, theta, beta = 0.1, 0.1, 1.8, 0.1, 0.1
-        delta = 0.2
-
-        # Concentrations
-        Cg, Cx, Cfa, Ce, Cn, Ca, Cb, Cz, Cy = [N/V for N in [Ng, Nx, Nfa, Ne, Nn, Na, Nb, Nz, Ny]]
-        Cco, Co = [N/Vg for N in [Nco, No]]
-
-        first_increase = (0.6 / 46 / 25 * 4) * Cy * 1.8
-        second_increase = 2/46/120*3.2
-        decrease = (0.6 / 46 / 40*3) * Cz/3
-        rZ = decrease + second_increase if Cz > 0 else 0  # decrease
-        rY = first_increase + decrease if Cy > 0 else 0  # increase
-
-        rFAf = 15e-3 * (Cg / (1e-2 + Cg)) - 0.5 * rZ
-        rEf = (second_increase + rY) * (Cg / (1e-5 + Cg))
-        theta_calc = theta * (Cg / (1e-3 + Cg))
-        RHS = [rFAf, rEf, 8e-5, theta_calc, 0]
-
-        rFAf, rTCA, rResp, rEf, rbio = self.rate_matrix_inv @ RHS
-
-        rG = -rFAf - rTCA - rEf - rbio
-        rX = 6 * rbio
-        rFA = 2*(rFAf + 0.5 * rZ)
-        rE = 2 * (rEf - rZ) * (Cg / (1e-5 + Cg))
-        rCO = -2 * rFAf + 6 * rTCA + 2 * rEf + alpha * rbio
-        rO = -0.5*rResp
-
-        # DE's
-        dNg = Fg_in*Cg_in - Fout*Cg + rG*Cx*V
-        dNx = rX*Cx*V
-        dNfa = -Fout*Cfa + rFA*Cx*V
-        dNe = -Fout*Ce + rE*Cx*V
-        dNco = Fco_in*Cco_in - Fg_out*Cco + rCO*Cx*V
-        dNo = Fo_in*Co_in - Fg_out*Co - rO*Cx*V
-        dNn = Fn_in*Cn_in - Fout*Cn - delta*rX*Cx*V
-        dNa = - Fout * Ca
-        dNb = Fb_in*Cb_in - Fout*Cb
-        dNz = -190*rZ*Cx*V
-        dNy = -95*rY*Cx*V
-        dV = Fg_in + Fn_in + Fb_in + Fm_in - Fout
-        dVg = Fco_in + Fo_in - Fg_out
-        dT = 4.5*Q - 0.25*(T - Tamb)
-
-        return dNg, dNx, dNfa, dNe, dNco, dNo, dNn, dNa, dNb, dNz, dNy, dV, dVg, dT
+        dX = batch_DEs(self.X[numpy.newaxis, :], self.inputs(t), self.constants)
+        return tuple(dX[0])
+
+    def jacobian(self, t):
+        """The derivatives of :meth:`DEs` with respect to the states and the inputs,
+        see :func:`batch_jacobian`
+
+        Parameters
+        ----------
+        t : float
+            The current time
+
+        Returns
+        -------
+        dfdX : 2d array_like
+            The derivatives with respect to the states, with shape (14, 14)
+
+        dfdU : 2d array_like
+            The derivatives with respect to the inputs, with shape (14, 15)
+        """
+        dfdX, dfdU = batch_jacobian(self.X[numpy.newaxis, :], self.inputs(t), self.constants)
+        return dfdX[0], dfdU[0]
 
     def step(self, dt):
         """Updates the model with inputs
@@ -134,64 +190,659 @@ class Model:
             Time since previous step
 
         """
-        self.t += dt
-        dX = self.DEs(self.t)
-        self.X += numpy.array(dX)*dt
-        self._Xs.append(self.outputs())
+        if self.integrator == 'euler':
+            self.X = propagate(self.X, self.t, dt, self.inputs, constants=self.constants)
+            self.t += dt
+        else:
+            self._integrate(self.t + dt)
+            self.t += dt
+        self._history.append(self.t, X=self.X)
+
+    def _integrate(self, t_end):
+        """Integrates the model up to `t_end` with `scipy.integrate.solve_ivp`.
+        The integration is restarted whenever Nz or Ny is depleted,
+        because the rate expressions switch off at those points.
+
+        Parameters
+        ----------
+        t_end : float
+            The time up to which the model is integrated
+        """
+        def rhs(t, X):
+            return batch_DEs(X.T, self.inputs(t), self.constants).T
+
+        def depletion_event(index):
+            def event(_, X):
+                return X[index]
+            event.index = index
+            event.terminal = True
+            event.direction = -1
+            return event
+
+        self._segments = []
+        t = self.t
+        while t < t_end:
+            # Nz (9) and Ny (10) can only decrease, so an event is only needed while they are positive
+            events = [depletion_event(i) for i in [9, 10] if self.X[i] > 0]
+            sol = scipy.integrate.solve_ivp(rhs, (t, t_end), self.X, method=self.integrator,
+                                            rtol=self.rtol, atol=self.atol, events=events,
+                                            dense_output=True, vectorized=True)
+            if not sol.success:
+                raise RuntimeError(sol.message)
+
+            self.nfev += sol.nfev
+            self._segments.append(sol.sol)
+            t = sol.t[-1]
+            self.X = sol.y[:, -1].copy()
+            for event, t_events in zip(events, sol.t_events):
+                if len(t_events):
+                    self.X[event.index] = 0
+
+    def dense_output(self, t):
+        """Interpolates the state within the most recent adaptive step
+
+        Parameters
+        ----------
+        t : float or array_like
+            Times between the start and end of the most recent step
+
+        Returns
+        -------
+        X : array_like
+            The interpolated states
+        """
+        if not self._segments:
+            raise ValueError("Dense output is only available after an adaptive step")
+
+        ts = numpy.asarray(t, dtype=float)
+        X = numpy.empty(ts.shape + (len(self.X),))
+        t_ends = [segment.t_max for segment in self._segments[:-1]]
+        indices = numpy.searchsorted(t_ends, ts)
+        for i, segment in enumerate(self._segments):
+            mask = indices == i
+            if numpy.any(mask):
+                X[mask] = segment(ts[mask]).T
+        return X
 
     def calculate_pH(self):
         """Calculates the pH in the vessel.
+        The previous pH is used as the starting point of the solver
 
         Returns
         -------
         pH : float
             The pH of the tank
         """
-        K_fa1, K_fa2,  K_a, K_b, K_w = 10 ** (-3.03), 10 ** 4.44, 10 ** 8.08, 10 ** 0.56, 10 ** (-14)
         _, _, Nfa, _, _, _, _, Na, Nb, _, _, V, _, _ = self.X
-        C_fa = Nfa/V
-        C_a = Na/V
-        C_b = Nb/V
+        self._pH = float(calculate_pH(Nfa/V, Na/V, Nb/V, self._pH))
+        return self._pH
 
-        def charge_balance(pH_guess):
-            Ch = 10 ** (-pH_guess)
-            C_fa_minus = K_fa1 * C_fa / (K_fa1 + Ch)
-            C_fa_minus2 = K_fa2 * C_fa_minus / (K_fa2 + Ch)
-            C_cl_minus = K_a * C_a / (K_a + Ch)
-            C_oh_minus = K_w / Ch
-            C_na_plus = K_b * C_b / (K_b + C_oh_minus)
+    @property
+    def offset(self):
+        """The index of the first state that is stored, see :meth:`discard`"""
+        return self._history.offset
 
-            balance = Ch + C_na_plus - C_fa_minus - C_fa_minus2 - C_cl_minus - C_oh_minus
-            return balance
+    def discard(self, n):
+        """Frees the states before index `n`, e.g. once they have been written to disk.
+        The views returned afterwards start at :attr:`offset`
 
-        pHs = numpy.linspace(0, 14, 100)
-        CBs = charge_balance(pHs)
-        index = numpy.argmin(abs(CBs))
-        pH = pHs[index]
-        if abs(CBs[index]) > 1e-1:
-            print('ph CB:', CBs[index])
+        Parameters
+        ----------
+        n : int
+            The index of the first state to keep
+        """
+        self._history.discard(n)
 
-        return pH
+    def get_Xs(self):
+        """Gets a read-only view of all the states that are stored"""
+        return self._history.view('X')
 
-    def outputs(self):
-        """Returns all the outputs (state and calculated)
+    def get_ts(self):
+        """Gets a read-only view of the times of the stored states"""
+        return self._history.ts
 
-        Returns
-        -------
-        outputs : array_like
-            List of all the outputs from the model
+    def get_pHs(self):
+        """Gets the pH for every stored state.
+        Only the states added since the previous call are calculated; the rest are cached
         """
+        n = len(self._history)
+        offset = self._history.offset
+        start = max(self._n_pH, offset)
+        if start < n:
+            _, _, Nfa, _, _, _, _, Na, Nb, _, _, V, _, _ = self._history.view('X')[start - offset:].T
+            pH0 = self._history.get('pH', start - 1) if start > offset else None
+            self._history.write('pH', start, calculate_pH(Nfa/V, Na/V, Nb/V, pH0))
+            self._n_pH = n
+        return self._history.view('pH')
+
+    def get_data(self):
+        """Gets a read-only view of all relevant information from the object """
         if self.pH_calculations:
-            pH = self.calculate_pH()
-            outs = numpy.append(self.X, pH)
-        else:
-            outs = self.X
-        return outs
+            self.get_pHs()
+            return self._history.view('X', 'pH')
+        return self.get_Xs()
+
+
+class EnsembleModel:
+    """Simulates an ensemble of N copies of the model together.
+    All the members are advanced by one call to :func:`propagate` per step,
+    so the inputs are only evaluated once per time for the whole ensemble.
+    Members can differ in their initial states and, through `constants`, in their kinetic constants
+
+    Parameters
+    ----------
+    X0s : 2d array_like
+        Initial states with shape (N, 14), one member per row
+
+    inputs : callable
+        Must take in a parameter t (the current time) and return an array_like of the current inputs.
+        Each input may be a scalar (shared by all members) or an array of length N
+
+    t : float, optional
+        Initial time.
+        Defaults to zero
+
+    constants : ModelConstants, optional
+        The constants used by the model equations.
+        Build them with :func:`model_constants` from arrays of length N to give each member its own values.
+        Defaults to :data:`CONSTANTS`
+
+    filename : string, optional
+        If given, the state history is stored in this memory-mapped file,
+        see :class:`history.History`.
+        Defaults to `None`, which keeps it in memory
+
+    capacity : int, optional
+        The number of steps for which history space is initially allocated.
+        Defaults to 1024
+
+    Attributes
+    -----------
+    Xs : 2d array_like
+        The current states with shape (N, 14)
+
+    inputs : callable
+        Must take in a parameter t (the current time) and return an array_like of the current inputs
+
+    t : float
+        The current time
+
+    constants : ModelConstants
+        The constants used by the model equations
+    """
+    def __init__(self, X0s, inputs, t=0, constants=CONSTANTS, filename=None, capacity=1024):
+        self.Xs = numpy.array(X0s, dtype=float)
+        self.inputs = inputs
+        self.t = t
+        self.constants = constants
+
+        self._history = history.History([('X', self.Xs.shape)], capacity, filename=filename)
+        self._history.append(self.t, X=self.Xs)
+
+    def __len__(self):
+        return len(self.Xs)
+
+    def step(self, dt, n_steps=1):
+        """Advances all the members with forward Euler steps, storing the states after each step
+
+        Parameters
+        ----------
+        dt : float
+            The size of each step
+
+        n_steps : int, optional
+            The number of steps to take.
+            Defaults to one
+        """
+        for _ in range(n_steps):
+            self.Xs = propagate(self.Xs, self.t, dt, self.inputs, constants=self.constants)
+            self.t += dt
+            self._history.append(self.t, X=self.Xs)
 
     def get_Xs(self):
-        """Gets all the states that are stored"""
-        return numpy.array(self._Xs)
+        """Gets a read-only view of all the states that are stored, with shape (T, N, 14)"""
+        return self._history.view('X')
 
-    def get_data(self):
-        """Gets all relevant information from the object """
-        return self.get_Xs()
+    def get_ts(self):
+        """Gets a read-only view of the times of the stored states"""
+        return self._history.ts
+
+    def flush(self):
+        """Writes the state history to its memory-mapped file, if any"""
+        self._history.flush()
+
+
+def _rate_products(rate_matrix_inv, RHS):
+    """Multiplies the right hand sides of the rate equations of each row by its inverse rate matrix
+
+    Parameters
+    ----------
+    rate_matrix_inv : 3d array_like
+        The contiguous stack of inverse rate matrices with shape (1, 5, 5) or (N, 5, 5)
+
+    RHS : list
+        The five right hand sides, each a scalar or an array whose first axis has the N rows
+
+    Returns
+    -------
+    rates : array_like
+        The five reaction rates on the first axis, followed by the axes of `RHS`
+    """
+    shape = numpy.broadcast(*RHS).shape
+    stacked = numpy.empty(shape[:1] + (len(RHS),) + shape[1:])
+    for j, rhs in enumerate(RHS):
+        stacked[:, j] = rhs
+    if stacked.ndim == 2:
+        return numpy.matmul(rate_matrix_inv, stacked[..., numpy.newaxis])[..., 0].T
+    return numpy.matmul(rate_matrix_inv, stacked).transpose(1, 0, 2)
+
+
+def batch_DEs(Xs, inputs, constants=CONSTANTS):
+    """Evaluates the differential equations of :class:`Model` for many states at once.
+    See :meth:`Model.DEs` for a description of the equations.
+
+    Parameters
+    ----------
+    Xs : 2d array_like
+        States with shape (N, 14), one state per row
+
+    inputs : array_like
+        The inputs as returned by an input object.
+        Each input may be a scalar (shared by all states) or an array of length N
+
+    constants : ModelConstants, optional
+        The constants used by the equations.
+        Defaults to :data:`CONSTANTS`
+
+    Returns
+    -------
+    dXs : 2d array_like
+        The differential changes to the state variables with shape (N, 14)
+    """
+    Ng, Nx, Nfa, Ne, Nco, No, Nn, Na, Nb, Nz, Ny, V, Vg, T = numpy.maximum(0, Xs).T
+    Fg_in, Cg_in, Fco_in, Cco_in, Fo_in, Co_in, \
+        Fg_out, Cn_in, Fn_in, Fb_in, Cb_in, Fm_in, Fout, Tamb, Q = inputs
+
+    alpha, PO, gamma, theta, beta, delta, k_first_increase, k_second_increase, k_decrease, rate_matrix_inv = constants
+
+    # Concentrations
+    Cg, Cx, Cfa, Ce, Cn, Ca, Cb, Cz, Cy = [N/V for N in [Ng, Nx, Nfa, Ne, Nn, Na, Nb, Nz, Ny]]
+    Cco, Co = [N/Vg for N in [Nco, No]]
+
+    # The factors are applied in the order of the original equations, so that the defaults round the same way
+    first_increase = k_first_increase * Cy * 1.8
+    second_increase = k_second_increase
+    decrease = k_decrease * Cz/3
+    rZ = numpy.where(Cz > 0, decrease + second_increase, 0)  # decrease
+    rY = numpy.where(Cy > 0, first_increase + decrease, 0)  # increase
+
+    rFAf = 15e-3 * (Cg / (1e-2 + Cg)) - 0.5 * rZ
+    rEf = (second_increase + rY) * (Cg / (1e-5 + Cg))
+    theta_calc = theta * (Cg / (1e-3 + Cg))
+    RHS = [rFAf, rEf, 8e-5, theta_calc, 0]
+
+    # Each row is multiplied as a separate matrix-vector product, which rounds exactly like the scalar product
+    rates = _rate_products(rate_matrix_inv, RHS)
+    rFAf, rTCA, rResp, rEf, rbio = rates
+
+    rG = -rFAf - rTCA - rEf - rbio
+    rX = 6 * rbio
+    rFA = 2*(rFAf + 0.5 * rZ)
+    rE = 2 * (rEf - rZ) * (Cg / (1e-5 + Cg))
+    rCO = -2 * rFAf + 6 * rTCA + 2 * rEf + alpha * rbio
+    rO = -0.5*rResp
+
+    # DE's
+    dNg = Fg_in*Cg_in - Fout*Cg + rG*Cx*V
+    dNx = rX*Cx*V
+    dNfa = -Fout*Cfa + rFA*Cx*V
+    dNe = -Fout*Ce + rE*Cx*V
+    dNco = Fco_in*Cco_in - Fg_out*Cco + rCO*Cx*V
+    dNo = Fo_in*Co_in - Fg_out*Co - rO*Cx*V
+    dNn = Fn_in*Cn_in - Fout*Cn - delta*rX*Cx*V
+    dNa = - Fout * Ca
+    dNb = Fb_in*Cb_in - Fout*Cb
+    dNz = -190*rZ*Cx*V
+    dNy = -95*rY*Cx*V
+    dV = Fg_in + Fn_in + Fb_in + Fm_in - Fout
+    dVg = Fco_in + Fo_in - Fg_out
+    dT = 4.5*Q - 0.25*(T - Tamb)
+
+    dXs = numpy.empty(Xs.shape)
+    for i, dN in enumerate([dNg, dNx, dNfa, dNe, dNco, dNo, dNn, dNa, dNb, dNz, dNy, dV, dVg, dT]):
+        dXs[:, i] = dN
+    return dXs
+
+
+def batch_jacobian(Xs, inputs, constants=CONSTANTS, with_inputs=True):
+    """Evaluates the Jacobians of :func:`batch_DEs` with respect to the states and the inputs for many states at once.
+    The derivatives are exact, including those through the inverse rate matrix and the divisions by V and Vg.
+    The clipping of negative states and the switching of the enzyme rates are differentiated piecewise:
+    a state of exactly zero is differentiated as if it were positive,
+    and an enzyme rate that is switched off has no derivative
+
+    Parameters
+    ----------
+    Xs : 2d array_like
+        States with shape (N, 14), one state per row
+
+    inputs : array_like
+        The inputs as returned by an input object.
+        Each input may be a scalar (shared by all states) or an array of length N
+
+    constants : ModelConstants, optional
+        The constants used by the equations.
+        Defaults to :data:`CONSTANTS`
+
+    with_inputs : bool, optional
+        If `False`, only the derivatives with respect to the states are evaluated, which takes about half the time.
+        Defaults to `True`
+
+    Returns
+    -------
+    dfdX : 3d array_like
+        The derivatives of the differential changes with respect to the states, with shape (N, 14, 14).
+        `dfdX[k, i, j]` is the derivative of the change in state `i` with respect to state `j` for row `k`
+
+    dfdU : 3d array_like
+        The derivatives of the differential changes with respect to the inputs, with shape (N, 14, 15).
+        `None` if `with_inputs` is `False`
+    """
+    Xs = numpy.asarray(Xs, dtype=float)
+    n, nx = Xs.shape
+    Us = numpy.empty((len(inputs), n))
+    for k, u in enumerate(inputs):
+        Us[k] = u
+
+    # Derivatives are taken with respect to the states followed by the inputs, along the last axis.
+    # Without the inputs, their rows of the identity are zero, so they are treated as constants
+    identity = numpy.eye(nx + len(Us), nx + len(Us) if with_inputs else nx)
+    d_Xs = numpy.where(Xs >= 0, 1., 0.)[:, :, numpy.newaxis] * identity[:nx]
+
+    Ng, Nx, Nfa, Ne, Nco, No, Nn, Na, Nb, Nz, Ny, V, Vg, T = numpy.maximum(0, Xs).T
+    d_Ng, d_Nx, d_Nfa, d_Ne, d_Nco, d_No, d_Nn, d_Na, d_Nb, d_Nz, d_Ny, d_V, d_Vg, d_T = d_Xs.transpose(1, 0, 2)
+    Fg_in, Cg_in, Fco_in, Cco_in, Fo_in, Co_in, \
+        Fg_out, Cn_in, Fn_in, Fb_in, Cb_in, Fm_in, Fout, Tamb, Q = Us
+    d_Fg_in, d_Cg_in, d_Fco_in, d_Cco_in, d_Fo_in, d_Co_in, \
+        d_Fg_out, d_Cn_in, d_Fn_in, d_Fb_in, d_Cb_in, d_Fm_in, d_Fout, d_Tamb, d_Q = identity[nx:]
+
+    alpha, PO, gamma, theta, beta, delta, k_first_increase, k_second_increase, k_decrease, rate_matrix_inv = constants
+
+    def column(a):
+        return numpy.asarray(a)[..., numpy.newaxis]
+
+    def d_product(a, d_a, b, d_b):
+        return d_a * column(b) + column(a) * d_b
+
+    def quotient(a, d_a, b, d_b):
+        q = a / b
+        return q, (d_a - column(q) * d_b) / column(b)
+
+    def monod(K):
+        return Cg / (K + Cg), column(K / (K + Cg)**2) * d_Cg
+
+    # Concentrations
+    Cg, d_Cg = quotient(Ng, d_Ng, V, d_V)
+    Cx, d_Cx = quotient(Nx, d_Nx, V, d_V)
+    Cfa, d_Cfa = quotient(Nfa, d_Nfa, V, d_V)
+    Ce, d_Ce = quotient(Ne, d_Ne, V, d_V)
+    Cn, d_Cn = quotient(Nn, d_Nn, V, d_V)
+    Ca, d_Ca = quotient(Na, d_Na, V, d_V)
+    Cb, d_Cb = quotient(Nb, d_Nb, V, d_V)
+    Cz, d_Cz = quotient(Nz, d_Nz, V, d_V)
+    Cy, d_Cy = quotient(Ny, d_Ny, V, d_V)
+    Cco, d_Cco = quotient(Nco, d_Nco, Vg, d_Vg)
+    Co, d_Co = quotient(No, d_No, Vg, d_Vg)
+
+    first_increase, d_first_increase = k_first_increase * Cy * 1.8, column(k_first_increase * 1.8) * d_Cy
+    second_increase = k_second_increase
+    decrease, d_decrease = k_decrease * Cz/3, column(k_decrease/3) * d_Cz
+    rZ = numpy.where(Cz > 0, decrease + second_increase, 0)
+    d_rZ = column(Cz > 0) * d_decrease
+    rY = numpy.where(Cy > 0, first_increase + decrease, 0)
+    d_rY = column(Cy > 0) * (d_first_increase + d_decrease)
+
+    mFA, d_mFA = monod(1e-2)
+    mE, d_mE = monod(1e-5)
+    mtheta, d_mtheta = monod(1e-3)
+
+    rFAf, d_rFAf = 15e-3 * mFA - 0.5 * rZ, 15e-3 * d_mFA - 0.5 * d_rZ
+    rEf, d_rEf = (second_increase + rY) * mE, d_product(second_increase + rY, d_rY, mE, d_mE)
+    theta_calc, d_theta_calc = theta * mtheta, column(theta) * d_mtheta
+    RHS = [rFAf, rEf, 8e-5, theta_calc, 0]
+    d_RHS = [d_rFAf, d_rEf, 0, d_theta_calc, 0]
+
+    rates = _rate_products(rate_matrix_inv, RHS)
+    d_rates = _rate_products(rate_matrix_inv, d_RHS)
+    rFAf, rTCA, rResp, rEf, rbio = rates
+    d_rFAf, d_rTCA, d_rResp, d_rEf, d_rbio = d_rates
+
+    rG, d_rG = -rFAf - rTCA - rEf - rbio, -d_rFAf - d_rTCA - d_rEf - d_rbio
+    rX, d_rX = 6 * rbio, 6 * d_rbio
+    d_rFA = 2*(d_rFAf + 0.5 * d_rZ)
+    rE, d_rE = 2 * (rEf - rZ) * mE, 2 * d_product(rEf - rZ, d_rEf - d_rZ, mE, d_mE)
+    rCO = -2 * rFAf + 6 * rTCA + 2 * rEf + alpha * rbio
+    d_rCO = -2 * d_rFAf + 6 * d_rTCA + 2 * d_rEf + column(alpha) * d_rbio
+    rO, d_rO = -0.5*rResp, -0.5*d_rResp
+    rFA = 2*(rFAf + 0.5 * rZ)
+
+    # Every reaction rate is multiplied by Cx*V
+    growth, d_growth = Cx * V, d_product(Cx, d_Cx, V, d_V)
+
+    def d_reaction(r, d_r):
+        return d_product(r, d_r, growth, d_growth)
+
+    J = numpy.empty((n, nx, identity.shape[1]))
+    J[:, 0] = d_product(Fg_in, d_Fg_in, Cg_in, d_Cg_in) - d_product(Fout, d_Fout, Cg, d_Cg) + d_reaction(rG, d_rG)
+    J[:, 1] = d_reaction(rX, d_rX)
+    J[:, 2] = -d_product(Fout, d_Fout, Cfa, d_Cfa) + d_reaction(rFA, d_rFA)
+    J[:, 3] = -d_product(Fout, d_Fout, Ce, d_Ce) + d_reaction(rE, d_rE)
+    J[:, 4] = d_product(Fco_in, d_Fco_in, Cco_in, d_Cco_in) - d_product(Fg_out, d_Fg_out, Cco, d_Cco) \
+        + d_reaction(rCO, d_rCO)
+    J[:, 5] = d_product(Fo_in, d_Fo_in, Co_in, d_Co_in) - d_product(Fg_out, d_Fg_out, Co, d_Co) - d_reaction(rO, d_rO)
+    J[:, 6] = d_product(Fn_in, d_Fn_in, Cn_in, d_Cn_in) - d_product(Fout, d_Fout, Cn, d_Cn) \
+        - column(delta) * d_reaction(rX, d_rX)
+    J[:, 7] = -d_product(Fout, d_Fout, Ca, d_Ca)
+    J[:, 8] = d_product(Fb_in, d_Fb_in, Cb_in, d_Cb_in) - d_product(Fout, d_Fout, Cb, d_Cb)
+    J[:, 9] = -190*d_reaction(rZ, d_rZ)
+    J[:, 10] = -95*d_reaction(rY, d_rY)
+    J[:, 11] = d_Fg_in + d_Fn_in + d_Fb_in + d_Fm_in - d_Fout
+    J[:, 12] = d_Fco_in + d_Fo_in - d_Fg_out
+    J[:, 13] = 4.5*d_Q - 0.25*(d_T - d_Tamb)
+
+    return J[:, :, :nx], J[:, :, nx:] if with_inputs else None
+
+
+def propagate(X, t, dt, inputs, n_steps=1, constants=CONSTANTS):
+    """Integrates the model equations with forward Euler steps.
+    This is the stateless core of :meth:`Model.step`: it keeps no history and makes no pH calculations
+
+    Parameters
+    ----------
+    X : array_like
+        The state, or states with shape (N, 14)
+
+    t : float
+        The time of the state
+
+    dt : float
+        The size of each Euler step
+
+    inputs : callable
+        Must take in a parameter t (the current time) and return an array_like of the current inputs
+
+    n_steps : int, optional
+        The number of Euler steps to take.
+        Defaults to one
+
+    constants : ModelConstants, optional
+        The constants used by the equations.
+        Defaults to :data:`CONSTANTS`
+
+    Returns
+    -------
+    X : array_like
+        The state(s) after `n_steps` steps
+    """
+    X = numpy.asarray(X, dtype=float)
+    Xs = numpy.atleast_2d(X)
+    for _ in range(n_steps):
+        t += dt
+        Xs = Xs + batch_DEs(Xs, inputs(t), constants)*dt
+    return Xs.reshape(X.shape)
+
+
+def linearize(X, t, dt, inputs, n_steps=1, constants=CONSTANTS):
+    """The Jacobian of :func:`propagate` with respect to the state,
+    with the model equations linearized once, around `X` at the time of the first step.
+    The linearized equations are integrated exactly with a matrix exponential over all `n_steps` steps.
+    The Euler steps themselves are not differentiated, because the Monod terms make the equations
+    too stiff for a linearized Euler step when glucose runs out
+
+    Parameters
+    ----------
+    X : array_like
+        The state, or states with shape (N, 14)
+
+    t, dt, inputs, n_steps, constants
+        As for :func:`propagate`
+
+    Returns
+    -------
+    F : array_like
+        The Jacobian with shape (14, 14), or (N, 14, 14) for several states
+    """
+    X = numpy.asarray(X, dtype=float)
+    dfdX, _ = batch_jacobian(numpy.atleast_2d(X), inputs(t + dt), constants, with_inputs=False)
+    F = numpy.array([scipy.linalg.expm(A*dt*n_steps) for A in dfdX])
+    return F.reshape(X.shape + X.shape[-1:])
+
+
+def charge_balance(pH, C_fa, C_a, C_b):
+    """Calculates the charge balance in the vessel and its derivative with respect to pH
+
+    Parameters
+    ----------
+    pH : float or array_like
+        The pH
+
+    C_fa, C_a, C_b : float or array_like
+        The concentrations of fumaric acid, acid and base
+
+    Returns
+    -------
+    balance : float or array_like
+        The net charge concentration
+
+    dbalance : float or array_like
+        The derivative of the net charge concentration with respect to pH
+    """
+    K_fa1, K_fa2,  K_a, K_b, K_w = 10 ** (-3.03), 10 ** 4.44, 10 ** 8.08, 10 ** 0.56, 10 ** (-14)
+    ln10 = math.log(10)
+
+    Ch = 10 ** (-pH)
+    C_fa_minus = K_fa1 * C_fa / (K_fa1 + Ch)
+    C_fa_minus2 = K_fa2 * C_fa_minus / (K_fa2 + Ch)
+    C_cl_minus = K_a * C_a / (K_a + Ch)
+    C_oh_minus = K_w / Ch
+    C_na_plus = K_b * C_b / (K_b + C_oh_minus)
+
+    balance = Ch + C_na_plus - C_fa_minus - C_fa_minus2 - C_cl_minus - C_oh_minus
+
+    dCh = -ln10 * Ch
+    dC_fa_minus = -C_fa_minus / (K_fa1 + Ch) * dCh
+    dC_fa_minus2 = (K_fa2 * dC_fa_minus - C_fa_minus2 * dCh) / (K_fa2 + Ch)
+    dC_cl_minus = -C_cl_minus / (K_a + Ch) * dCh
+    dC_oh_minus = ln10 * C_oh_minus
+    dC_na_plus = -C_na_plus / (K_b + C_oh_minus) * dC_oh_minus
+
+    dbalance = dCh + dC_na_plus - dC_fa_minus - dC_fa_minus2 - dC_cl_minus - dC_oh_minus
+    return balance, dbalance
+
+
+def calculate_pH(C_fa, C_a, C_b, pH0=None, tol=1e-10, max_iter=100):
+    """Solves the charge balance for the pH with a safeguarded Newton method.
+    The charge balance decreases monotonically with pH, so the root is kept bracketed in [0, 14]
+    and any Newton step that leaves the bracket is replaced by bisection.
+    Roots outside the bracket are clipped to its ends
+
+    Parameters
+    ----------
+    C_fa, C_a, C_b : float or array_like
+        The concentrations of fumaric acid, acid and base
+
+    pH0 : float or array_like, optional
+        Starting guess(es), such as the previous pH.
+        Defaults to 7
+
+    tol : float, optional
+        The tolerance on the pH.
+        Defaults to 1e-10
+
+    max_iter : int, optional
+        The maximum number of iterations.
+        Defaults to 100
+
+    Returns
+    -------
+    pH : float or array_like
+        The pH for each set of concentrations
+    """
+    if numpy.ndim(C_fa) == numpy.ndim(C_a) == numpy.ndim(C_b) == numpy.ndim(pH0) == 0:
+        return _calculate_pH_scalar(float(C_fa), float(C_a), float(C_b), pH0, tol, max_iter)
+
+    C_fa, C_a, C_b = numpy.broadcast_arrays(*[numpy.asarray(C, dtype=float) for C in (C_fa, C_a, C_b)])
+    shape = C_fa.shape
+    C_fa, C_a, C_b = C_fa.ravel(), C_a.ravel(), C_b.ravel()
+
+    lo = numpy.zeros_like(C_fa)
+    hi = numpy.full_like(C_fa, 14)
+    pH = numpy.full_like(C_fa, 7) if pH0 is None else numpy.clip(numpy.broadcast_to(pH0, shape).ravel(), 0, 14)
+
+    active = numpy.arange(len(pH))
+    for _ in range(max_iter):
+        if len(active) == 0:
+            break
+        p = pH[active]
+        balance, dbalance = charge_balance(p, C_fa[active], C_a[active], C_b[active])
+
+        above = balance > 0
+        lo[active] = numpy.where(above, p, lo[active])
+        hi[active] = numpy.where(above, hi[active], p)
+
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            p_new = numpy.where(balance == 0, p, p - balance / dbalance)
+        outside = ~((p_new >= lo[active]) & (p_new <= hi[active]))
+        p_new[outside] = (lo[active][outside] + hi[active][outside]) / 2
+
+        pH[active] = p_new
+        done = (numpy.abs(p_new - p) < tol) | (hi[active] - lo[active] < tol) | (balance == 0)
+        active = active[~done]
+
+    pH = pH.reshape(shape)
+    return pH[()] if pH.ndim == 0 else pH
+
+
+def _calculate_pH_scalar(C_fa, C_a, C_b, pH0, tol, max_iter):
+    """The same method as :func:`calculate_pH` for a single set of concentrations.
+    Plain floats avoid the overhead of small arrays"""
+    lo, hi = 0., 14.
+    pH = 7. if pH0 is None else min(max(float(pH0), lo), hi)
+    for _ in range(max_iter):
+        balance, dbalance = charge_balance(pH, C_fa, C_a, C_b)
+        if balance == 0:
+            break
+        if balance > 0:
+            lo = pH
+        else:
+            hi = pH
+
+        pH_new = pH - balance / dbalance if dbalance else numpy.nan
+        if not lo <= pH_new <= hi:
+            pH_new = (lo + hi) / 2
+
+        converged = abs(pH_new - pH) < tol or hi - lo < tol
+        pH = pH_new
+        if converged:
+            break
+    return pH
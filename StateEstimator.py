@@ -1,8 +1,13 @@
+import math
 import numpy
 import scipy
-import filterpy.kalman
 from AdjMerweScaledSigmaPoints import MerweScaledSigmaPoints
 import Model
+import history
+import propagators
+import kalmanFilters
+import schedulers
+import timing
 
 
 class StateEstimator:
@@ -19,13 +24,79 @@ class StateEstimator:
     t_predict : float
         The period between state estimator predictions
 
+    schedule : {'fixed', 'elapsed'}, optional
+        How the interval covered by each prediction is chosen.
+        `'fixed'` predicts `t_predict` ahead of the step that triggers the prediction,
+        see :class:`schedulers.FixedScheduler`.
+        For compatibility with earlier versions its propagations cover more than the period,
+        twice as much for periods shorter than 0.2, see :class:`FXObj`.
+        `'elapsed'` predicts over the time that has passed since the previous prediction,
+        coalescing missed periods, see :class:`schedulers.ElapsedScheduler`.
+        Defaults to `'fixed'`
+
+    max_predict_interval : float, optional
+        The longest interval that a single `'elapsed'` prediction covers.
+        Defaults to `None`, which means there is no limit
+
+    covariance_storage : {'full', 'packed', 'checkpoint'}, optional
+        How the covariance history is stored, see :class:`history.CovarianceHistory`.
+        Plotting only needs the standard deviations, which are always stored.
+        Defaults to `'full'`
+
+    covariance_dtype : data-type, optional
+        The type in which the covariance history is stored, e.g. `numpy.float32`.
+        Defaults to `float`
+
+    checkpoint_interval : int, optional
+        The number of steps between stored covariances for the `'checkpoint'` storage.
+        Backdated updates roll back to the last stored covariance,
+        and the updates made since then are applied again as the predicts are replayed,
+        so the estimates are the same as with `'full'` storage.
+        Defaults to 100
+
+    max_backdate : float, optional
+        The furthest into the past that an update can be backdated.
+        Older updates are applied at this horizon, which bounds the work done by a replay.
+        Defaults to `None`, which means there is no limit
+
+    workers : int, optional
+        If given, sigma points are propagated in parallel by a pool of this many processes.
+        Call :meth:`close` to shut the pool down.
+        Defaults to `None`, which propagates them in this process
+
+    method : {'ukf', 'srukf', 'ekf'}, optional
+        The filter to use.
+        `'ukf'` is :class:`kalmanFilters.UnscentedKalmanFilter`,
+        which takes a matrix square root of the covariance on every predict.
+        `'srukf'` is :class:`kalmanFilters.SquareRootUnscentedKalmanFilter`,
+        which propagates a Cholesky factor of the covariance instead.
+        `'ekf'` is :class:`kalmanFilters.ExtendedKalmanFilter`,
+        which propagates only the estimate and linearizes the model around it with :func:`Model.linearize`.
+        It approximates the `'ukf'` filter to first order.
+        It does not use sigma points, so `workers` is ignored.
+        The sigma points of `'ukf'` are propagated as one batch, which costs about as much as a single trajectory,
+        so it is only somewhat cheaper: it skips the matrix square root and linearizes once per `jacobian_period`.
+        Defaults to `'ukf'`
+
+    jacobian_period : float, optional
+        For the `'ekf'` method, the linearization made by the first predict in each period of this length
+        is reused by the other predicts of the same length in the period, see :class:`FXObj`.
+        Defaults to `None`, which is five times `t_predict`
+
+    timer : timing.LatencyTimer, optional
+        Records the durations of the `'se_predict'`, `'propagation'`, `'se_update'` and `'se_replay'` phases,
+        and counts the `'predicts'`, `'updates'` and `'replayed_predicts'`.
+        `'se_update'` includes the replays of a backdated update,
+        and `'se_replay'` is recorded separately for each stretch of steps replayed between two updates.
+        Defaults to a new timer
+
     Attributes
     -----------
     inputs : callable
         Must take in a parameter t (the current time) and return an array_like of the current inputs
 
     ts : array_like
-        List of times that the state estimator has been run
+        List of times that the state estimator has been run, from :attr:`offset` onwards
 
     Q : 2d array
         A matrix of state covariances
@@ -40,10 +111,16 @@ class StateEstimator:
         The number of states
 
     sigmas : MerweScaledSigmaPoints
-        A sigma point generating object
+        A sigma point generating object.
+        `None` for the `'ekf'` method
+
+    propagator : {propagators.SerialPropagator, propagators.PoolPropagator}
+        Propagates the sigma points through `fx`.
+        `None` for the `'ekf'` method
 
-    ukf : filterpy.kalman.UnscentedKalmanFilter
-        A UKF implementation
+    ukf : {kalmanFilters.UnscentedKalmanFilter, kalmanFilters.SquareRootUnscentedKalmanFilter,
+           kalmanFilters.ExtendedKalmanFilter}
+        The filter implementation
 
     t : float
         The current time
@@ -54,38 +131,100 @@ class StateEstimator:
     t_predict : float
         The period between state estimator predictions
 
+    scheduler : {schedulers.FixedScheduler, schedulers.ElapsedScheduler}
+        Chooses the interval covered by each prediction
+
     t_next_predicts : array_like
-        An array of all past prediction times
+        An array of all past prediction times, from :attr:`offset` onwards
+
+    max_backdate : float
+        The furthest into the past that an update can be backdated
+
+    replayed_predicts : int
+        The number of predicts that have been redone by backdated updates
+
+    timer : timing.LatencyTimer
+        Records the latencies of the estimator
 
     """
-    def __init__(self, X0, inputs, t_predict):
+    def __init__(self, X0, inputs, t_predict, schedule='fixed', max_predict_interval=None,
+                 covariance_storage='full', covariance_dtype=float, checkpoint_interval=100,
+                 max_backdate=None, workers=None, method='ukf', jacobian_period=None, timer=None):
         self.inputs = inputs
+        if schedule == 'fixed':
+            self.scheduler = schedulers.FixedScheduler(t_predict)
+        elif schedule == 'elapsed':
+            self.scheduler = schedulers.ElapsedScheduler(t_predict, max_predict_interval)
+        else:
+            raise ValueError("Unknown prediction schedule '{}'".format(schedule))
+        self.max_backdate = max_backdate
+        self.replayed_predicts = 0
+        self.timer = timing.LatencyTimer() if timer is None else timer
 
-        self._Xs = [X0]
-        self._Ps = [numpy.zeros((len(X0), len(X0)))]
-        self._deviations = [[0] * len(X0)]
-        self.ts = [0]
+        nx = len(X0)
+        self.t = 0
+        self.t_next_predict = self.scheduler.first_predict(self.t)
+        self.t_predict = t_predict
+
+        self._history = history.History([('X', (nx,)), ('deviations', (nx,)), ('t_next_predict', ())])
+        self._covariances = history.CovarianceHistory(nx, covariance_storage, covariance_dtype,
+                                                      checkpoint_interval)
+        # The row after which each update was applied, and its observations, in the order of the rows
+        self._updates = []
 
         #                           Ng, Nx, Nfa, Ne, Nco, No, Nn, Na, Nb, Nz, Ny, V, Vg, T
         self.Q = numpy.diag(numpy.array([1e-6, 1e-3, 1e-5, 1e-4, 1e-5, 1e-5, 1e-5,
                                          1e-5, 1e-5, 1e-2, 1e-2, 1e-5, 1e-5, 1e-1]))
         self.R = numpy.diag(numpy.array([1e-12, 1e-12, 1e-12]))
 
-        self.fx = self.FXObj(self.inputs)
+        if method == 'ekf' and jacobian_period is None:
+            jacobian_period = 5 * t_predict
+        # The fixed schedule keeps the step size of earlier versions, so that its estimates are unchanged
+        self.fx = self.FXObj(self.inputs, legacy_steps=schedule == 'fixed', jacobian_period=jacobian_period)
         self.nx = len(self.Q)
 
-        self.sigmas = MerweScaledSigmaPoints(self.nx, 1e-3, 2, 0, sqrt_method=scipy.linalg.sqrtm)
-        self.ukf = filterpy.kalman.UnscentedKalmanFilter(self.nx, 3, 0, self.hx, self.fx, self.sigmas)
+        alpha = 1e-3
+        if method == 'ukf':
+            self.sigmas = MerweScaledSigmaPoints(self.nx, alpha, 2, 0, sqrt_method=scipy.linalg.sqrtm)
+        elif method == 'srukf':
+            self.sigmas = MerweScaledSigmaPoints(self.nx, alpha, 2, 0)
+        elif method == 'ekf':
+            self.sigmas = None
+        else:
+            raise ValueError("Unknown filter method '{}'".format(method))
+
+        if method == 'ekf':
+            self.propagator = None
+        elif workers is None:
+            self.propagator = propagators.SerialPropagator(self.fx)
+        else:
+            self.propagator = propagators.PoolPropagator(self.fx, self.sigmas.num_sigmas(), self.nx, workers)
+
+        if self.propagator is not None:
+            propagator = propagators.TimedPropagator(self.propagator, self.timer)
+
+        if method == 'ukf':
+            self.ukf = kalmanFilters.UnscentedKalmanFilter(self.nx, 3, self.hx, propagator, self.sigmas)
+        elif method == 'ekf':
+            self.ukf = kalmanFilters.ExtendedKalmanFilter(self.nx, 3, self.hx, self.hx_jacobian,
+                                                          self.fx, self.fx.jacobian, spread=alpha**2)
+        else:
+            self.ukf = kalmanFilters.SquareRootUnscentedKalmanFilter(self.nx, 3, self.hx, propagator, self.sigmas)
 
         self.ukf.x = X0
         self.ukf.Q = self.Q
         self.ukf.R = self.R
 
-        self.t = 0
-        self.t_next_predict = 0
-        self.t_predict = t_predict
+        # The initial row holds the covariance that the filter starts from, which backdated updates roll back to
+        self._record([self.t])
+
+    @property
+    def ts(self):
+        return self._history.ts
 
-        self.t_next_predicts = [self.t_next_predict]
+    @property
+    def t_next_predicts(self):
+        return self._history.view('t_next_predict')
 
     @staticmethod
     def hx(x):
@@ -93,31 +232,103 @@ class StateEstimator:
         Parameters
         ----------
         x : array_like
-            A list of the states
+            A list of the states, or an array with one state per row
 
         Returns
         -------
         z : array_like
-            A list of the observations in measurement space
+            A list of the observations in measurement space, or an array with one row per state
 
         """
-        Ng, _, Nfa, Ne, _, _, _, _, _, _, _, V, _, _ = x
-        z = Ng/V, Nfa/V, Ne/V
+        x = numpy.asarray(x)
+        Ng, Nfa, Ne, V = x[..., 0], x[..., 2], x[..., 3], x[..., 11]
+        z = numpy.stack([Ng/V, Nfa/V, Ne/V], axis=-1)
         return z
 
+    @staticmethod
+    def hx_jacobian(x):
+        """
+        Parameters
+        ----------
+        x : array_like
+            A list of the states
+
+        Returns
+        -------
+        H : 2d array_like
+            The Jacobian of :meth:`hx` with respect to the states
+
+        """
+        Ng, _, Nfa, Ne, _, _, _, _, _, _, _, V, _, _ = x
+        H = numpy.zeros((3, len(x)))
+        H[[0, 1, 2], [0, 2, 3]] = 1/V
+        H[:, 11] = -numpy.array([Ng, Nfa, Ne])/V**2
+        return H
+
     class FXObj:
-        def __init__(self, inputs, t=0):
+        """Propagates states, or an array of states with one per row, over a prediction period.
+        The period is split into `int(dt*5 + 2)` Euler steps
+
+        Parameters
+        ----------
+        inputs : callable
+            Must take in a parameter t (the current time) and return an array_like of the current inputs
+
+        t : float, optional
+            The start time of the propagation.
+            Defaults to 0
+
+        legacy_steps : bool, optional
+            If `True`, the steps are `dt/(n_steps - 1)` long as in earlier versions,
+            so that a propagation covers `n_steps/(n_steps - 1)` times the period.
+            Defaults to `False`, which covers the period exactly
+
+        jacobian_period : float, optional
+            If given, :meth:`jacobian` is only evaluated for the first propagation that starts in each period
+            of this length, and reused for the propagations over the same time step that follow in the period.
+            The Jacobians of propagations that are rolled back are discarded with :meth:`forget`,
+            so the estimates do not depend on how far back a backdated update rolls.
+            Defaults to `None`, which evaluates it every time
+        """
+        def __init__(self, inputs, t=0, legacy_steps=False, jacobian_period=None):
             self.t = t
             self.inputs = inputs
+            self.legacy_steps = legacy_steps
+            self.jacobian_period = jacobian_period
+            # The start time and Jacobian of the first propagation of each time step in each period
+            self._jacobians = {}
+
+        def _steps(self, dt):
+            """The number and size of the Euler steps over a period"""
+            n_steps = int(dt*5 + 2)
+            return n_steps, dt / (n_steps - 1 if self.legacy_steps else n_steps)
 
         def __call__(self, x, dt):
-            ts = numpy.linspace(0, dt, int(dt*5 + 2))
-            dt_small = ts[1]
-            m_f = Model.Model(x, self.inputs)
-            m_f.t = self.t
-            for _ in ts:
-                m_f.step(dt_small)
-            return m_f.X
+            n_steps, dt_small = self._steps(dt)
+            return Model.propagate(x, self.t, dt_small, self.inputs, n_steps)
+
+        def jacobian(self, x, dt):
+            """The Jacobian of the propagation with respect to the state, see :func:`Model.linearize`"""
+            n_steps, dt_small = self._steps(dt)
+            if self.jacobian_period is None:
+                return Model.linearize(x, self.t, dt_small, self.inputs, n_steps)
+
+            key = (math.floor(self.t / self.jacobian_period), dt)
+            if key not in self._jacobians:
+                self._jacobians[key] = self.t, Model.linearize(x, self.t, dt_small, self.inputs, n_steps)
+            return self._jacobians[key][1]
+
+        def forget(self, t):
+            """Discards the Jacobians of propagations that started at or after `t`,
+            e.g. when the estimate is rolled back to before them"""
+            self._jacobians = {key: value for key, value in self._jacobians.items() if value[0] < t}
+
+        def discard(self, t):
+            """Discards the Jacobians of the periods that end before `t`,
+            e.g. when no propagation can start before `t` again"""
+            if self.jacobian_period is not None:
+                period = math.floor(t / self.jacobian_period)
+                self._jacobians = {key: value for key, value in self._jacobians.items() if key[0] >= period}
 
     def step(self, dt):
         """Steps the object through time
@@ -130,16 +341,78 @@ class StateEstimator:
         self.t += dt
 
         if self.t > self.t_next_predict:
-            self.fx.t = self.t
-            self.ukf.predict(self.t_predict)
-            self.t_next_predict = self.t + self.t_predict
+            with self.timer.phase('se_predict'):
+                self._predict()
+            self.timer.count('predicts')
+
+        self._record([self.t])
+
+    def _predict(self):
+        """Predicts over the interval that the scheduler gives for the current time"""
+        t_start, dt = self.scheduler.interval(self.t, self.t_next_predict)
+        self.fx.t = t_start
+        self.ukf.predict(dt)
+        self.t_next_predict = self.scheduler.next_predict(t_start, dt)
+
+    def _record(self, ts):
+        """Adds the current estimate to the history at each time in `ts`"""
+        self._history.extend(ts, X=self.ukf.x, deviations=numpy.sqrt(numpy.diag(self.ukf.P)),
+                             t_next_predict=self.t_next_predict)
+        self._covariances.extend(self.ukf.P, len(ts))
+
+    def _replay(self, ts):
+        """Steps through the times `ts` again.
+        The estimate only changes at a predict, so the steps between predicts are recorded in blocks
 
-        self._Xs.append(self.ukf.x)
-        self._Ps.append(self.ukf.P)
-        self._deviations.append(numpy.sqrt(numpy.diag(self.ukf.P)))
+        Parameters
+        ----------
+        ts : array_like
+            The times to step through
+        """
+        i = 0
+        while i < len(ts):
+            # Steps up to and including t_next_predict do not predict
+            j = i + ts[i:].searchsorted(self.t_next_predict, side='right')
+            if j > i:
+                self._record(ts[i:j])
+            if j < len(ts):
+                self.t = ts[j]
+                self._predict()
+                self._record(ts[j:j + 1])
+                self.replayed_predicts += 1
+                self.timer.count('replayed_predicts')
+            i = j + 1
+
+        if len(ts):
+            self.t = ts[-1]
+
+    def _rollback(self, index):
+        """Finds the number of rows to keep when an update is backdated to row `index`.
+        Every update after the kept rows is done again, with the sigma points of the predict that led up to it,
+        so the kept rows end before those predicts, at a row for which the covariance is stored
 
-        self.ts.append(self.t)
-        self.t_next_predicts.append(self.t_next_predict)
+        Parameters
+        ----------
+        index : int
+            The row after which the update is made
+
+        Returns
+        -------
+        keep : int
+            The number of rows to keep
+        """
+        t_next_predicts = self.t_next_predicts
+        offset = self._history.offset
+        first = index
+        while True:
+            # The predict that led up to a row is the first row with the same next prediction time
+            predicted = offset + t_next_predicts.searchsorted(t_next_predicts[first - offset])
+            # The initial state is always kept
+            keep = self._covariances.last_stored(max(predicted - 1, 0)) + 1
+            redone = [row for row, _ in self._updates if keep - 1 <= row < first]
+            if not redone:
+                return keep
+            first = min(redone)
 
     def update(self, z, t=numpy.nan):
         """ Performs an update step
@@ -150,46 +423,110 @@ class StateEstimator:
             A list of the observations
 
         t : float
-            The time at which the observations took place
+            The time at which the observations took place.
+            Times more than `max_backdate` in the past are moved forward to that horizon.
+            The estimates after that time are replayed, redoing the updates made since then
         """
-        if t is numpy.nan:
-            self.ukf.update(z)
-        else:
-            # The update is back dated so we find the time at which it was taken
-            index = numpy.searchsorted(self.ts, t) - 1
-            ts_old = self.ts[index:]
-
-            # Remove now invalid data
-            self._Xs = self._Xs[:index]
-            self._Ps = self._Ps[:index]
-            self._deviations = self._deviations[:index]
-            self.ts = self.ts[:index]
-            self.t_next_predicts = self.t_next_predicts[:index]
-
-            # Reset the UKF for sigma calc
-            self.ukf.x = self._Xs[-1]
-            self.ukf.P = self._Ps[-1]
-            self.t = self.ts[-1]
-            self.t_next_predict = self.t_next_predicts[-1]
-            self.step(ts_old[0] - self.t)
-
-            # Do the update
-            self.ukf.update(z)
-
-            # Step forward in time again
-            for t_i in ts_old[1:]:
-                self.step(t_i - self.t)
+        z = numpy.array(z, dtype=float)
+        with self.timer.phase('se_update'):
+            if t is numpy.nan:
+                self.ukf.update(z)
+                self._updates.append((len(self._history) - 1, z))
+            else:
+                if self.max_backdate is not None:
+                    t = max(t, self.t - self.max_backdate)
+
+                # The update is back dated so we find the time at which it was taken.
+                # Updates from before the first step are made after the initial state
+                index = max(self._history.searchsorted(t) - 1, 0)
+                keep = self._rollback(index)
+                ts_old = self.ts[keep - self._history.offset:].copy()
+
+                # The updates made after the last kept row are applied again, in order, along with this one
+                redo = [update for update in self._updates if update[0] >= keep - 1]
+                del self._updates[len(self._updates) - len(redo):]
+                redo.append((index, z))
+                redo.sort(key=lambda update: update[0])
+
+                # Remove now invalid data
+                self._history.truncate(keep)
+                self._covariances.truncate(keep)
+
+                # Reset the UKF for sigma calc
+                self.ukf.x = self._history.get('X')
+                self.ukf.P = self._covariances.get()
+                self.t = self.ts[-1]
+                self.t_next_predict = float(self._history.get('t_next_predict'))
+                # The predicts that are replayed start at or after the next prediction time of the last kept row
+                self.fx.forget(self.t_next_predict)
+
+                # Step forward in time again, doing the updates along the way
+                start = keep
+                for row, z_row in redo:
+                    with self.timer.phase('se_replay'):
+                        self._replay(ts_old[start - keep:row - keep + 1])
+                    self.ukf.update(z_row)
+                    self._updates.append((row, z_row))
+                    start = row + 1
+                with self.timer.phase('se_replay'):
+                    self._replay(ts_old[start - keep:])
+
+        self.timer.count('updates')
+
+    def close(self):
+        """Shuts down the sigma point propagation workers, if any"""
+        if self.propagator is not None:
+            self.propagator.close()
+
+    @property
+    def offset(self):
+        """The index of the first row of the history that is kept, see :meth:`discard`"""
+        return self._history.offset
+
+    def discard(self, n):
+        """Frees the rows of the history before index `n`, e.g. once they have been written to disk.
+        Rows that a later backdated update could roll back to are kept,
+        so rows are only freed if `max_backdate` is set.
+        The views returned afterwards start at :attr:`offset`
+
+        Parameters
+        ----------
+        n : int
+            The index of the first row that needs to be kept
+        """
+        if self.max_backdate is None:
+            return
+
+        # Later updates are made at or after the current horizon, and roll back no further than it does
+        index = max(self._history.searchsorted(self.t - self.max_backdate) - 1, self._history.offset)
+        n = min(n, self._rollback(index) - 1)
+        if n <= self._history.offset:
+            return
+        self.fx.discard(self.ts[n - self._history.offset])
+        self._history.discard(n)
+        self._covariances.discard(n)
+        self._updates = [update for update in self._updates if update[0] >= n]
+
+    @property
+    def revision(self):
+        """The number of times that backdated updates have rewritten the history"""
+        return self._history.revision
+
+    def first_changed(self, revision):
+        """The index of the first row of the history that was rewritten since `revision`,
+        see :meth:`history.History.first_changed`"""
+        return self._history.first_changed(revision)
 
     def get_Xs(self):
-        """Get the _Xs array
+        """Get a read-only view of the state history
         """
-        return numpy.array(self._Xs)
+        return self._history.view('X')
 
     def get_deviations(self):
-        """Get the _deviations array
+        """Get a read-only view of the standard deviation history
         """
-        return numpy.array(self._deviations)
+        return self._history.view('deviations')
 
     def get_data(self):
-        """Get all the data from the object"""
-        return numpy.concatenate([self.get_Xs(), self.get_deviations()], axis=1)
+        """Get a read-only view of all the data from the object"""
+        return self._history.view('X', 'deviations')
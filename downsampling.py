@@ -0,0 +1,192 @@
+# Contains the downsampling of long trajectories for plotting
+import numpy
+
+
+class MinMaxDownsampler:
+    """Reduces a trajectory to the smallest and largest point in each of a bounded number of buckets.
+    Buckets hold a fixed number of consecutive rows, which doubles whenever the trajectory
+    would need more than `max_points / 2` buckets, so peaks and dips of any width are kept.
+    Rows are passed in incrementally with :meth:`extend`, and only the buckets that they fall in are recomputed.
+    Rows that are rewritten can be discarded with :meth:`rewind` and passed in again
+
+    Parameters
+    ----------
+    max_points : int, optional
+        The most points that :meth:`points` returns, not counting the last row, which is always included.
+        Defaults to 2000
+
+    Attributes
+    ----------
+    max_points : int
+        The most points that are returned
+
+    n : int
+        The number of rows that have been passed in
+
+    size : int
+        The number of rows in each bucket
+
+    Examples
+    --------
+    >>> downsampler = MinMaxDownsampler(max_points=4)
+    >>> downsampler.extend(numpy.arange(8.), numpy.array([0., 5, 1, 1, 1, 1, -3, 2]))
+    >>> downsampler.points()
+    (array([0., 1., 6., 7.]), array([ 0.,  5., -3.,  2.]))
+    """
+    def __init__(self, max_points=2000):
+        self.max_points = max_points
+        self.n = 0
+        self.size = 1
+
+        n_buckets = max(1, max_points // 2)
+        self._nb = 0
+        self._x_min = numpy.empty(n_buckets)
+        self._y_min = numpy.empty(n_buckets)
+        self._x_max = numpy.empty(n_buckets)
+        self._y_max = numpy.empty(n_buckets)
+        self._last = (numpy.nan, numpy.nan)
+
+    def rewind(self, start):
+        """Discards the rows from index `start` onwards.
+        The rows of the bucket that `start` falls in must be passed in again, from the start of the bucket
+
+        Parameters
+        ----------
+        start : int
+            The index of the first row to discard
+
+        Returns
+        -------
+        n : int
+            The index of the first row that must be passed to :meth:`extend` next
+        """
+        if start < self.n:
+            self._nb = start // self.size
+            self.n = self._nb * self.size
+        return self.n
+
+    def extend(self, x, y, start=None):
+        """Adds rows to the end of the trajectory
+
+        Parameters
+        ----------
+        x, y : array_like
+            The coordinates of the rows
+
+        start : int, optional
+            The index of the first row, if the rows from :attr:`n` up to it are not available.
+            They are filled with the first row, so that the buckets stay aligned with the row indices.
+            Defaults to :attr:`n`
+        """
+        x = numpy.asarray(x, dtype=float)
+        y = numpy.asarray(y, dtype=float)
+        if start is not None and start > self.n and len(y):
+            x = numpy.concatenate([numpy.full(start - self.n, x[0]), x])
+            y = numpy.concatenate([numpy.full(start - self.n, y[0]), y])
+        m = len(y)
+        if m == 0:
+            return
+
+        while -(-(self.n + m) // self.size) > len(self._x_min):
+            self._coarsen()
+
+        size = self.size
+        # Completes the partially filled last bucket
+        head = min((-self.n) % size, m)
+        if head:
+            b = self._nb - 1
+            i_min, i_max = numpy.argmin(y[:head]), numpy.argmax(y[:head])
+            if y[i_min] < self._y_min[b]:
+                self._x_min[b], self._y_min[b] = x[i_min], y[i_min]
+            if y[i_max] > self._y_max[b]:
+                self._x_max[b], self._y_max[b] = x[i_max], y[i_max]
+
+        # Fills new buckets
+        if m > head:
+            rest_x, rest_y = x[head:], y[head:]
+            k = -(-len(rest_y) // size)
+            padding = k * size - len(rest_y)
+            if padding:
+                rest_x = numpy.append(rest_x, numpy.full(padding, rest_x[-1]))
+                rest_y = numpy.append(rest_y, numpy.full(padding, rest_y[-1]))
+            rest_x = rest_x.reshape(k, size)
+            rest_y = rest_y.reshape(k, size)
+            rows = numpy.arange(k)
+            i_min, i_max = numpy.argmin(rest_y, axis=1), numpy.argmax(rest_y, axis=1)
+            buckets = slice(self._nb, self._nb + k)
+            self._x_min[buckets], self._y_min[buckets] = rest_x[rows, i_min], rest_y[rows, i_min]
+            self._x_max[buckets], self._y_max[buckets] = rest_x[rows, i_max], rest_y[rows, i_max]
+            self._nb += k
+
+        self.n += m
+        self._last = (x[-1], y[-1])
+
+    def _coarsen(self):
+        """Doubles the bucket size by merging neighbouring buckets"""
+        nb = self._nb
+        pairs = nb // 2
+        first, second = slice(0, 2 * pairs, 2), slice(1, 2 * pairs, 2)
+        take_min = self._y_min[second] < self._y_min[first]
+        take_max = self._y_max[second] > self._y_max[first]
+        for values, take in [(self._x_min, take_min), (self._y_min, take_min),
+                             (self._x_max, take_max), (self._y_max, take_max)]:
+            values[:pairs] = numpy.where(take, values[second], values[first])
+            if nb % 2:
+                values[pairs] = values[nb - 1]
+        self._nb = -(-nb // 2)
+        self.size *= 2
+
+    def points(self):
+        """The downsampled trajectory
+
+        Returns
+        -------
+        x, y : array_like
+            The smallest and largest point of each bucket in the order in which they occur, and the last row
+        """
+        nb = self._nb
+        if not nb:
+            return numpy.empty(0), numpy.empty(0)
+        x_min, y_min = self._x_min[:nb], self._y_min[:nb]
+        x_max, y_max = self._x_max[:nb], self._y_max[:nb]
+        min_first = x_min <= x_max
+        x = numpy.empty((nb, 2))
+        y = numpy.empty((nb, 2))
+        x[:, 0] = numpy.where(min_first, x_min, x_max)
+        y[:, 0] = numpy.where(min_first, y_min, y_max)
+        x[:, 1] = numpy.where(min_first, x_max, x_min)
+        y[:, 1] = numpy.where(min_first, y_max, y_min)
+        x = numpy.append(x.ravel(), self._last[0])
+        y = numpy.append(y.ravel(), self._last[1])
+
+        # Buckets whose smallest and largest points are the same point, and the last row, repeat points
+        new = numpy.ones(len(x), dtype=bool)
+        new[1:] = (x[1:] != x[:-1]) | (y[1:] != y[:-1])
+        return x[new], y[new]
+
+
+def min_max(x, y, max_points=2000):
+    """Downsamples a whole trajectory, see :class:`MinMaxDownsampler`
+
+    Parameters
+    ----------
+    x, y : array_like
+        The coordinates of the trajectory
+
+    max_points : int, optional
+        The most points returned, not counting the last one.
+        Defaults to 2000
+
+    Returns
+    -------
+    x, y : array_like
+        The downsampled trajectory.
+        Trajectories that already have at most `max_points` points are returned as arrays unchanged
+    """
+    x = numpy.asarray(x, dtype=float)
+    y = numpy.asarray(y, dtype=float)
+    if len(y) <= max_points:
+        return x, y
+    downsampler = MinMaxDownsampler(max_points)
+    downsampler.extend(x, y)
+    return downsampler.points()
@@ -0,0 +1,342 @@
+# Contains the estimation of the kinetic parameters of the model from the HPLC data of past runs
+import hashlib
+import math
+import multiprocessing
+import os
+import numpy
+import pandas
+import scipy.optimize
+import Model
+import inputters
+
+# Biomass C H_1.8 O_0.5 N_0.2 => 24.6 g/mol
+#     Ng, Nx, Nfa, Ne, Nco, No, Nn, Na, Nb, Nz, Ny, V, Vg, T
+X0 = [0, 4.6/24.6, 0, 0, 0, 0, 0, 1e-5, 0, 5.1, 1.2, 1.077, 0.1, 25]
+
+FIT_NAMES = tuple(name for name in Model.PARAMETER_NAMES if name != 'PO')
+"""The parameters that are fitted by default: all of :data:`Model.PARAMETER_NAMES` except `PO`,
+which the model equations do not use"""
+
+
+class Experiment:
+    """The inputs and HPLC measurements of a past run, and the simulation of the model over it
+
+    Parameters
+    ----------
+    glucose_data_file : string
+        The name of the csv file that contains the glucose data, see :class:`inputters.FakeInputs`
+
+    update_data_file : string
+        The name of the csv file that contains the HPLC data, see :class:`stateUpdaters.FakeStateUpdate`
+
+    X0 : array_like, optional
+        The initial states.
+        Defaults to the initial states used by the simulation
+
+    dt : float, optional
+        The largest Euler step used in simulations.
+        Defaults to 0.2
+
+    Attributes
+    ----------
+    inputs : inputters.FakeInputs
+        The inputs of the run
+
+    ts : array_like
+        The times of the measurements
+
+    Cs : 2d array_like
+        The measured glucose, fumaric acid and ethanol concentrations in mol/L, one row per measurement
+
+    scales : array_like
+        The largest measured concentration of each component, used to scale the misfit
+
+    key : string
+        A hash that identifies the run and the simulation settings
+    """
+    def __init__(self, glucose_data_file, update_data_file, X0=X0, dt=0.2):
+        self.inputs = inputters.FakeInputs(glucose_data_file)
+        self.X0 = numpy.array(X0, dtype=float)
+        self.dt = dt
+
+        concentration = pandas.read_csv(update_data_file)
+        measured = concentration['Time'] > 0
+        self.ts = concentration['Time'][measured].to_numpy(dtype=float)
+        self.Cs = (concentration[['Glucose', 'Fumaric', 'Ethanol']][measured] / [180, 116, 46]).to_numpy()
+        scales = self.Cs.max(axis=0)
+        self.scales = numpy.where(scales > 0, scales, 1)
+
+        key = hashlib.sha1()
+        for array in [self.X0, numpy.array([dt]), self.inputs._ts, self.inputs._CgFgs, self.ts, self.Cs]:
+            key.update(array.tobytes())
+        self.key = key.hexdigest()
+
+    def simulate(self, constants):
+        """Simulates the run and returns the concentrations at the measurement times
+
+        Parameters
+        ----------
+        constants : ModelConstants
+            The constants used by the model equations
+
+        Returns
+        -------
+        Cs : 2d array_like
+            The simulated glucose, fumaric acid and ethanol concentrations in mol/L, one row per measurement
+        """
+        X, t = self.X0, 0.
+        Cs = numpy.empty(self.Cs.shape)
+        for i, t_meas in enumerate(self.ts):
+            n_steps = max(1, math.ceil((t_meas - t) / self.dt))
+            X = Model.propagate(X, t, (t_meas - t) / n_steps, self.inputs, n_steps, constants)
+            t = t_meas
+            Cs[i] = X[[0, 2, 3]] / X[11]
+        return Cs
+
+
+class Misfit:
+    """The misfit between the model and the measurements of one or more runs,
+    as a function of a vector of kinetic parameters.
+    The squared differences are scaled by the largest measurement of each component in each run.
+    Simulated trajectories are cached by a hash of the parameters and the run,
+    so repeated evaluations (e.g. while refitting) are not simulated again.
+    The cache is kept by the process that evaluates the misfit;
+    :meth:`workers` simulates the missing trajectories of many parameter vectors in a pool of processes
+
+    Parameters
+    ----------
+    experiments : list
+        The :class:`Experiment` objects to fit
+
+    names : list, optional
+        The names of the parameters in the vector, see :data:`Model.PARAMETER_NAMES`.
+        Parameters that are not named keep their default values.
+        Defaults to :data:`FIT_NAMES`
+
+    cache_dir : string, optional
+        A directory in which trajectories are also cached as files, so that they are shared by later fits.
+        Defaults to `None`, which only caches them in memory
+
+    Attributes
+    ----------
+    experiments : list
+        The runs to fit
+
+    names : list
+        The names of the parameters in the vector
+
+    cache_dir : string
+        The directory in which trajectories are cached, if any
+
+    hits, misses : int
+        The number of trajectories that were found in, or missing from, the cache
+    """
+    def __init__(self, experiments, names=FIT_NAMES, cache_dir=None):
+        self.experiments = experiments
+        self.names = list(names)
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+        self._cache = {}
+
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def constants(self, parameters):
+        """The model constants for a parameter vector
+
+        Parameters
+        ----------
+        parameters : array_like
+            The values of the parameters in `names`
+
+        Returns
+        -------
+        constants : ModelConstants
+            The constants used by the model equations
+        """
+        return Model.model_constants(**dict(zip(self.names, parameters)))
+
+    def trajectory(self, parameters, experiment):
+        """The simulated concentrations of a run, from the cache if they are in it
+
+        Parameters
+        ----------
+        parameters : array_like
+            The values of the parameters in `names`
+
+        experiment : Experiment
+            The run
+
+        Returns
+        -------
+        Cs : 2d array_like
+            The simulated concentrations at the measurement times
+        """
+        key = self._key(parameters, experiment)
+        Cs = self._lookup(key)
+        if Cs is not None:
+            self.hits += 1
+            return Cs
+
+        self.misses += 1
+        Cs = experiment.simulate(self.constants(parameters))
+        self._store(key, Cs)
+        return Cs
+
+    def _key(self, parameters, experiment):
+        """The cache key of the trajectory of a run for a parameter vector"""
+        key = hashlib.sha1(numpy.asarray(parameters, dtype=float).tobytes())
+        key.update(' '.join(self.names + [experiment.key]).encode())
+        return key.hexdigest()
+
+    def _filename(self, key):
+        """The file in which a trajectory is cached, if there is a cache directory"""
+        return None if self.cache_dir is None else os.path.join(self.cache_dir, key + '.npy')
+
+    def _lookup(self, key):
+        """Finds a trajectory in memory or on disk, or returns `None`"""
+        filename = self._filename(key)
+        if key not in self._cache and filename is not None and os.path.exists(filename):
+            self._cache[key] = numpy.load(filename)
+        return self._cache.get(key)
+
+    def _store(self, key, Cs):
+        """Adds a trajectory to the cache"""
+        self._cache[key] = Cs
+        filename = self._filename(key)
+        if filename is not None:
+            # Written under a temporary name so that other processes never read a partial file
+            temporary = '{}.{}.npy'.format(filename[:-4], os.getpid())
+            numpy.save(temporary, Cs)
+            os.replace(temporary, filename)
+
+    def workers(self, pool_map):
+        """Makes a map function that evaluates the misfit of many parameter vectors,
+        for the `workers` argument of `scipy.optimize.differential_evolution`.
+        The trajectories that are not in the cache are simulated with `pool_map`
+        and added to the cache before the misfits are evaluated in this process
+
+        Parameters
+        ----------
+        pool_map : callable
+            The `map` method of a `multiprocessing.Pool` whose workers were given the same experiments
+            when they started, as in :func:`fit`
+
+        Returns
+        -------
+        workers : callable
+            Takes the function to evaluate and the parameter vectors, and returns the values in order
+        """
+        def evaluate(function, population):
+            population = [numpy.asarray(parameters, dtype=float) for parameters in population]
+            missing = {}
+            for parameters in population:
+                for index, experiment in enumerate(self.experiments):
+                    key = self._key(parameters, experiment)
+                    if key not in missing and self._lookup(key) is None:
+                        missing[key] = (self.names, parameters, index)
+
+            for key, Cs in zip(missing, pool_map(_simulate, missing.values())):
+                if Cs is not None:
+                    self._store(key, Cs)
+
+            hits, misses = self.hits, self.misses
+            values = [function(parameters) for parameters in population]
+            # Every trajectory was looked up again above, but only the missing ones were simulated
+            self.hits = hits + len(population) * len(self.experiments) - len(missing)
+            self.misses = misses + len(missing)
+            return values
+        return evaluate
+
+    def __call__(self, parameters):
+        total = 0.
+        for experiment in self.experiments:
+            try:
+                with numpy.errstate(all='ignore'):
+                    residuals = (self.trajectory(parameters, experiment) - experiment.Cs) / experiment.scales
+            except numpy.linalg.LinAlgError:
+                # The rate matrix is singular for these parameters
+                return numpy.inf
+            total += numpy.mean(residuals**2)
+        return total if numpy.isfinite(total) else numpy.inf
+
+
+def fit(experiments, names=FIT_NAMES, bounds=None, workers=None, cache_dir=None,
+        maxiter=100, seed=None):
+    """Fits kinetic parameters of the model to the measurements of past runs with differential evolution.
+    Each generation of candidate parameter vectors is simulated in parallel by a pool of processes
+
+    Parameters
+    ----------
+    experiments : list
+        The :class:`Experiment` objects to fit
+
+    names : list, optional
+        The names of the parameters to fit.
+        Defaults to :data:`FIT_NAMES`
+
+    bounds : list, optional
+        A `(lower, upper)` pair for each parameter.
+        Defaults to a fifth and five times the default value of each parameter
+
+    workers : int, optional
+        The number of worker processes.
+        Defaults to the number of CPUs
+
+    cache_dir : string, optional
+        A directory in which simulated trajectories are cached, see :class:`Misfit`
+
+    maxiter : int, optional
+        The maximum number of generations.
+        Defaults to 100
+
+    seed : int, optional
+        Seeds the random number generator of the optimiser
+
+    Returns
+    -------
+    constants : ModelConstants
+        The constants with the fitted parameters
+
+    result : scipy.optimize.OptimizeResult
+        The result of the optimisation
+    """
+    names = list(names)
+    misfit = Misfit(experiments, names, cache_dir)
+    if bounds is None:
+        defaults = Model.model_constants()
+        bounds = [sorted([getattr(defaults, name) / 5, getattr(defaults, name) * 5]) for name in names]
+
+    with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(experiments,)) as pool:
+        result = scipy.optimize.differential_evolution(misfit, bounds, maxiter=maxiter, seed=seed,
+                                                       workers=misfit.workers(pool.map), updating='deferred',
+                                                       polish=False)
+    return misfit.constants(result.x), result
+
+
+# The experiments as seen by a worker process
+_experiments = None
+
+
+def _init_worker(experiments):
+    """Gives a worker process the experiments once, when it starts, see :meth:`Misfit.workers`"""
+    global _experiments
+    _experiments = experiments
+
+
+def _simulate(task):
+    """Simulates an experiment in a worker process, or returns `None` if the rate matrix is singular"""
+    names, parameters, index = task
+    try:
+        return _experiments[index].simulate(Model.model_constants(**dict(zip(names, parameters))))
+    except numpy.linalg.LinAlgError:
+        return None
+
+
+if __name__ == '__main__':
+    runs = [Experiment('data/run_{}_glucose.csv'.format(run), 'data/run_{}_conc.csv'.format(run)) for run in [7, 9]]
+    fitted, optimisation = fit(runs, cache_dir='results/fitting_cache')
+    print(optimisation.message, optimisation.fun)
+    for parameter in FIT_NAMES:
+        print(parameter, getattr(fitted, parameter))
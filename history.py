@@ -0,0 +1,446 @@
+import numpy
+
+
+class History:
+    """Stores time stamped rows of fixed shape in preallocated arrays.
+    The arrays double in size when they are full, so appending is amortized O(1).
+    Reading returns read-only views of the stored data instead of copies.
+    Old rows can be freed with :meth:`discard`, after which the arrays only hold the rows from :attr:`offset` onwards
+
+    Parameters
+    ----------
+    fields : list
+        A list of `(name, shape)` pairs that make up each row.
+        Fields are stored side by side in a single array, in the given order
+
+    capacity : int, optional
+        The number of rows for which space is initially allocated.
+        Defaults to 1024
+
+    dtype : data-type, optional
+        The type in which the fields are stored.
+        Time stamps are always stored as floats.
+        Defaults to `float`
+
+    filename : string, optional
+        If given, the fields are stored in a memory-mapped file instead of in memory.
+        The file is overwritten and holds the raw rows, including unused capacity at its end,
+        so it can be opened with `numpy.memmap(filename, dtype).reshape(-1, width)`.
+        Time stamps are kept in memory.
+        Defaults to `None`
+
+    Attributes
+    ----------
+    fields : list
+        A list of `(name, shape)` pairs that make up each row
+
+    filename : string
+        The memory-mapped file, if any
+
+    revision : int
+        The number of times that the history has been truncated, see :meth:`first_changed`
+
+    offset : int
+        The index of the first row that is kept, see :meth:`discard`
+    """
+    def __init__(self, fields, capacity=1024, dtype=float, filename=None):
+        self.fields = [(name, tuple(shape)) for name, shape in fields]
+        self.filename = filename
+
+        self._columns = {}
+        start = 0
+        for name, shape in self.fields:
+            width = int(numpy.prod(shape))
+            self._columns[name] = (start, start + width, shape)
+            start += width
+
+        self._n = 0
+        self.offset = 0
+        self.revision = 0
+        self._truncations = []
+        self._ts = numpy.empty(capacity)
+        if filename is None:
+            self._data = numpy.empty((capacity, start), dtype=dtype)
+        else:
+            open(filename, 'wb').close()
+            self._data = self._map((capacity, start), dtype)
+
+    def __len__(self):
+        return self._n
+
+    @property
+    def ts(self):
+        """A read-only view of the time stamps of the kept rows"""
+        return self._readonly(self._ts[:self._n - self.offset])
+
+    def append(self, t, **values):
+        """Adds a row to the end of the history.
+        Fields that are not given are filled with NaN
+
+        Parameters
+        ----------
+        t : float
+            The time stamp of the row
+
+        values : array_like
+            The values of the fields, given by name
+        """
+        if self._n - self.offset == len(self._ts):
+            self._grow()
+
+        row = self._data[self._n - self.offset]
+        if len(values) < len(self.fields):
+            row[:] = numpy.nan
+        for name, value in values.items():
+            start, stop, _ = self._columns[name]
+            row[start:stop] = numpy.ravel(value)
+        self._ts[self._n - self.offset] = t
+        self._n += 1
+
+    def extend(self, ts, **values):
+        """Adds several rows to the end of the history.
+        Fields that are not given are filled with NaN
+
+        Parameters
+        ----------
+        ts : array_like
+            The time stamps of the rows
+
+        values : array_like
+            The values of the fields, given by name.
+            Either one value per row or a single value for all the rows
+        """
+        m = len(ts)
+        n = self._n - self.offset
+        while n + m > len(self._ts):
+            self._grow()
+
+        rows = self._data[n:n + m]
+        if len(values) < len(self.fields):
+            rows[:] = numpy.nan
+        for name, value in values.items():
+            start, stop, _ = self._columns[name]
+            rows[:, start:stop] = numpy.reshape(value, (-1, stop - start))
+        self._ts[n:n + m] = ts
+        self._n += m
+
+    def write(self, name, start, values):
+        """Overwrites the values of a field in stored rows
+
+        Parameters
+        ----------
+        name : string
+            The name of the field
+
+        start : int
+            The index of the first row to write
+
+        values : array_like
+            The new values, one per row
+        """
+        values = numpy.asarray(values)
+        first, last, _ = self._columns[name]
+        start -= self.offset
+        self._data[start:start + len(values), first:last] = values.reshape(len(values), -1)
+
+    def truncate(self, n):
+        """Discards all rows from index `n` onwards.
+        The space is kept for new rows.
+        Rows before :attr:`offset` have already been freed, so at least the rows up to it are counted as kept
+
+        Parameters
+        ----------
+        n : int
+            The number of rows to keep
+        """
+        self._n = max(self.offset, min(n, self._n))
+        self._truncations.append(self._n)
+        self.revision += 1
+
+    def discard(self, n):
+        """Frees the rows before index `n`, e.g. once they have been written to disk.
+        The kept rows are moved to the start of the arrays, so the space is reused for new rows.
+        Rows keep their indices, but :attr:`ts` and :meth:`view` only cover the rows from :attr:`offset` onwards
+
+        Parameters
+        ----------
+        n : int
+            The index of the first row to keep
+        """
+        n = min(n, self._n)
+        if n <= self.offset:
+            return
+        start, stop = n - self.offset, self._n - self.offset
+        self._ts[:stop - start] = self._ts[start:stop]
+        self._data[:stop - start] = self._data[start:stop]
+        self.offset = int(n)
+
+    def first_changed(self, revision):
+        """Finds the first row that may have been replaced since the history was at a revision.
+        Readers that keep derived data can use this to only recompute the rows that changed
+
+        Parameters
+        ----------
+        revision : int
+            The :attr:`revision` at which the rows were read
+
+        Returns
+        -------
+        index : int
+            The index of the first row that was discarded since then,
+            or the current length if no rows were discarded
+        """
+        return min(self._truncations[revision:], default=self._n)
+
+    def searchsorted(self, t, side='left'):
+        """Finds the index at which a time would be inserted to keep the time stamps sorted
+
+        Parameters
+        ----------
+        t : float or array_like
+            The time(s) to find
+
+        side : {'left', 'right'}, optional
+            See `numpy.searchsorted`.
+            Defaults to `'left'`
+        """
+        return self.offset + self._ts[:self._n - self.offset].searchsorted(t, side=side)
+
+    def view(self, *names):
+        """Gets a read-only view of one or more adjacent fields for the rows from :attr:`offset` onwards.
+        The view shares memory with the history,
+        so rows that are rewritten after a :meth:`truncate` also change in the view
+
+        Parameters
+        ----------
+        names : string
+            The names of the fields, in the order in which they are stored.
+            If no names are given, all fields are returned
+
+        Returns
+        -------
+        view : array_like
+            An array of shape `(n,) + shape` for a single field,
+            or `(n, width)` for several fields, where `n` is the number of kept rows
+        """
+        if not names:
+            names = [name for name, _ in self.fields]
+        start, _, shape = self._columns[names[0]]
+        stop = self._columns[names[-1]][1]
+        if len(names) > 1:
+            shape = (stop - start,)
+            columns = [self._columns[name][:2] for name in names]
+            if any(a[1] != b[0] for a, b in zip(columns, columns[1:])):
+                raise ValueError("Only adjacent fields can be viewed together")
+
+        n = self._n - self.offset
+        data = self._data[:n, start:stop]
+        return self._readonly(data.reshape((n,) + shape))
+
+    def get(self, name, index=-1):
+        """Gets a copy of the value of a field in one row
+
+        Parameters
+        ----------
+        name : string
+            The name of the field
+
+        index : int, optional
+            The index of the row, which must not be before :attr:`offset`.
+            Defaults to the last row
+        """
+        if index < 0:
+            index += self._n
+        if not self.offset <= index < self._n:
+            raise IndexError("index {} is out of range for rows {} to {}".format(index, self.offset, self._n))
+        start, stop, shape = self._columns[name]
+        return self._data[index - self.offset, start:stop].reshape(shape).copy()
+
+    def flush(self):
+        """Writes the stored rows to the memory-mapped file, if any"""
+        if self.filename is not None:
+            self._data.flush()
+
+    def _grow(self):
+        """Doubles the capacity of the arrays"""
+        n = self._n - self.offset
+        for name in ['_ts', '_data']:
+            old = getattr(self, name)
+            shape = (2*len(old),) + old.shape[1:]
+            if name == '_data' and self.filename is not None:
+                # The file is extended in place, so the stored rows are not copied
+                old.flush()
+                setattr(self, name, self._map(shape, old.dtype))
+                continue
+            new = numpy.empty(shape, dtype=old.dtype)
+            new[:n] = old[:n]
+            setattr(self, name, new)
+
+    def _map(self, shape, dtype):
+        """Extends the file to fit an array of `shape` and maps it"""
+        with open(self.filename, 'r+b') as f:
+            f.truncate(int(numpy.prod(shape)) * numpy.dtype(dtype).itemsize)
+        return numpy.memmap(self.filename, dtype=dtype, mode='r+', shape=shape)
+
+    @staticmethod
+    def _readonly(array):
+        array.flags.writeable = False
+        return array
+
+
+class CovarianceHistory:
+    """Stores a covariance matrix for every step of a filter, using one of several storage policies. \n
+    `'full'`: every matrix is stored. \n
+    `'packed'`: the upper triangle of every matrix is stored, which is enough to rebuild it. \n
+    `'checkpoint'`: full matrices are only stored every `checkpoint_interval` rows.
+    The diagonals of the other rows are expected to be kept elsewhere,
+    e.g. as standard deviations in the filter's own history,
+    and a filter that rolls back to one of them restarts from the last stored matrix and recomputes the rest.
+
+    Parameters
+    ----------
+    n : int
+        The size of the covariance matrices
+
+    storage : {'full', 'packed', 'checkpoint'}, optional
+        The storage policy.
+        Defaults to `'full'`
+
+    dtype : data-type, optional
+        The type in which the matrices are stored, e.g. `numpy.float32` to halve the memory.
+        Defaults to `float`
+
+    checkpoint_interval : int, optional
+        The number of rows between stored matrices for the `'checkpoint'` policy.
+        Defaults to 100
+
+    capacity : int, optional
+        The number of rows for which space is initially allocated.
+        Defaults to 1024
+
+    Attributes
+    ----------
+    n : int
+        The size of the covariance matrices
+
+    storage : string
+        The storage policy
+
+    checkpoint_interval : int
+        The number of rows between stored matrices for the `'checkpoint'` policy
+    """
+    def __init__(self, n, storage='full', dtype=float, checkpoint_interval=100, capacity=1024):
+        if storage not in ['full', 'packed', 'checkpoint']:
+            raise ValueError("Unknown covariance storage policy '{}'".format(storage))
+
+        self.n = n
+        self.storage = storage
+        self.checkpoint_interval = checkpoint_interval if storage == 'checkpoint' else 1
+
+        self._n = 0
+        self._triu = numpy.triu_indices(n)
+        shape = (len(self._triu[0]),) if storage == 'packed' else (n, n)
+        if storage == 'checkpoint':
+            capacity = capacity // checkpoint_interval + 1
+        # The time stamps of the stored matrices are their row indices
+        self._stored = History([('P', shape)], capacity, dtype)
+
+    def __len__(self):
+        return self._n
+
+    def append(self, P):
+        """Adds the covariance matrix of the next row
+
+        Parameters
+        ----------
+        P : 2d array_like
+            The covariance matrix
+        """
+        if self._n % self.checkpoint_interval == 0:
+            P = numpy.asarray(P)
+            self._stored.append(self._n, P=P[self._triu] if self.storage == 'packed' else P)
+        self._n += 1
+
+    def extend(self, P, count):
+        """Adds the same covariance matrix for several rows
+
+        Parameters
+        ----------
+        P : 2d array_like
+            The covariance matrix
+
+        count : int
+            The number of rows
+        """
+        first = -(-self._n // self.checkpoint_interval) * self.checkpoint_interval
+        rows = numpy.arange(first, self._n + count, self.checkpoint_interval)
+        if len(rows):
+            P = numpy.asarray(P)
+            self._stored.extend(rows, P=P[self._triu] if self.storage == 'packed' else P)
+        self._n += count
+
+    def truncate(self, n):
+        """Discards all rows from index `n` onwards
+
+        Parameters
+        ----------
+        n : int
+            The number of rows to keep
+        """
+        self._n = max(0, min(n, self._n))
+        self._stored.truncate(self._stored.searchsorted(self._n))
+
+    def discard(self, n):
+        """Frees the stored matrices that are not needed to get the rows from index `n` onwards,
+        see :meth:`History.discard`
+
+        Parameters
+        ----------
+        n : int
+            The index of the first row that must stay available
+        """
+        self._stored.discard(min(n, self._n) // self.checkpoint_interval)
+
+    def last_stored(self, index):
+        """Finds the last row at or before `index` for which the full matrix is available
+
+        Parameters
+        ----------
+        index : int
+            The index of the row
+
+        Returns
+        -------
+        index : int
+            The index of the row
+        """
+        index = index % self._n
+        return index - index % self.checkpoint_interval
+
+    def get(self, index=-1):
+        """Gets the full covariance matrix of a row
+
+        Parameters
+        ----------
+        index : int, optional
+            The index of the row.
+            Defaults to the last row
+
+        Returns
+        -------
+        P : 2d array_like
+            The covariance matrix
+        """
+        index = index % self._n
+        if index % self.checkpoint_interval:
+            raise ValueError("The covariance of row {} is not stored; "
+                             "use last_stored to find a row that is".format(index))
+
+        stored = self._stored.get('P', index // self.checkpoint_interval).astype(float)
+        if self.storage != 'packed':
+            return stored
+
+        P = numpy.empty((self.n, self.n))
+        P[self._triu] = stored
+        P.T[self._triu] = stored
+        return P
@@ -1,9 +1,12 @@
+import bisect
 import numpy
 import pandas
+import history
 
 
 class FakeInputs:
-    """Creates fake inputs for the glucose feed from past data
+    """Creates fake inputs for the glucose feed from past data.
+    The glucose schedule and all constant inputs are compiled once so that lookups are cheap
 
     Parameters
     -----------
@@ -14,13 +17,23 @@ class FakeInputs:
     -----------
     glucose : pandas.Dataframe
         An object containing the info from the glucose file
+
+    constants : dict
+        The inputs that do not change with time
     """
     def __init__(self, glucose_data_file):
         self.glucose = pandas.read_csv(glucose_data_file)
 
-    def __call__(self, t):
+        ts = self.glucose['Time'].to_numpy(dtype=float)
+        CgFgs = self.glucose['Glucose dosing (g/h)'].to_numpy(dtype=float)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            slopes = numpy.diff(CgFgs) / numpy.diff(ts)
+        self._ts, self._CgFgs = ts, CgFgs
+        # Plain lists are faster than arrays for the scalar lookups
+        self._ts_list, self._CgFgs_list, self._slopes_list = ts.tolist(), CgFgs.tolist(), slopes.tolist()
+        self._cursor = 0
+
         Cg_in = 314.19206 / 180  # (g/L) / (g/mol) = mol/L
-        Fg_in = self.CgFg(t) / 180 / Cg_in  # (g/h) / (g/mol) / (mol/L) = L/h
 
         Qco_in = 8.67 / 1000 * 60  # (ml / min) / (ml/L) * (min/h) = L/h
         Fco_in = 87 * Qco_in / 8.314 / 298  # (kPa) * (L/h) / (L*kPa/mol/K) / (K) = mol/h
@@ -39,26 +52,76 @@ class FakeInputs:
         Cb_in = 10  # mol/L
 
         Fm_in = 0
-        F_out = Fg_in + Fn_in + Fb_in + Fm_in
 
         T_amb = 25
         Q = 5 / 9
 
-        return Fg_in, Cg_in, Fco_in, Cco_in, Fo_in, Co_in, Fg_out, Cn_in, Fn_in, Fb_in, Cb_in, Fm_in, F_out, T_amb, Q
+        self.constants = dict(Cg_in=Cg_in, Fco_in=Fco_in, Cco_in=Cco_in, Fo_in=Fo_in, Co_in=Co_in,
+                              Fg_out=Fg_out, Cn_in=Cn_in, Fn_in=Fn_in, Fb_in=Fb_in, Cb_in=Cb_in,
+                              Fm_in=Fm_in, T_amb=T_amb, Q=Q)
+
+    def __call__(self, t):
+        """Looks up the inputs
+
+        Parameters
+        ----------
+        t : float or array_like
+            The time(s) at which the inputs should be looked up
+
+        Returns
+        -------
+        inputs : tuple
+            The inputs. If `t` is an array then each input is an array of the same shape
+        """
+        c = self.constants
+        Fg_in = self.CgFg(t) / 180 / c['Cg_in']  # (g/h) / (g/mol) / (mol/L) = L/h
+        F_out = Fg_in + c['Fn_in'] + c['Fb_in'] + c['Fm_in']
+
+        inputs = (Fg_in, c['Cg_in'], c['Fco_in'], c['Cco_in'], c['Fo_in'], c['Co_in'], c['Fg_out'],
+                  c['Cn_in'], c['Fn_in'], c['Fb_in'], c['Cb_in'], c['Fm_in'], F_out, c['T_amb'], c['Q'])
+        if numpy.ndim(t):
+            inputs = tuple(numpy.broadcast_arrays(*inputs))
+        return inputs
 
     def CgFg(self, t):
-        """Interpolates the value from the glucose file
+        """Interpolates the value from the glucose file.
+        Scalar lookups remember the last interval used,
+        so that sequential lookups do not need to search the file
 
         Parameters
         ----------
-        t : float
+        t : float or array_like
             The value of time at which the input should be looked up
         """
-        return numpy.interp(t, self.glucose['Time'], self.glucose['Glucose dosing (g/h)'])  # g/h
+        if numpy.ndim(t):
+            return numpy.interp(t, self._ts, self._CgFgs)  # g/h
+
+        ts = self._ts_list
+        if t < ts[0]:
+            return self._CgFgs_list[0]
+        if t >= ts[-1]:
+            return self._CgFgs_list[-1]
+
+        i = self._cursor
+        if not ts[i] <= t < ts[i + 1]:
+            if ts[i + 1] <= t < ts[i + 2]:
+                i += 1
+            else:
+                i = bisect.bisect_right(ts, t) - 1
+            self._cursor = i
+        return self._slopes_list[i] * (t - ts[i]) + self._CgFgs_list[i]  # g/h
 
 
 class LabviewInputs:
-    """Stores and looks up input values from Labview
+    """Stores and looks up input values from Labview.
+    Inputs are kept in a :class:`history.History`
+    and are converted to engineering units once, when they are received
+
+    Parameters
+    ----------
+    capacity : int, optional
+        The number of inputs for which space is initially allocated.
+        Defaults to 1024
 
     Attributes
     -----------
@@ -66,7 +129,7 @@ class LabviewInputs:
         Stores the time stamp information about the inputs
 
     inputs : array_like
-        Stores the inputs
+        Stores the raw inputs
 
     Cg_in : float, constant
         The glucose feed concentration
@@ -100,10 +163,14 @@ class LabviewInputs:
 
     Q_fact : float, constant
         A multiplier for the heater gain
+
+    offsets, spans : array_like, constant
+        Calibration of the raw Labview channels
     """
-    def __init__(self):
-        self.ts = []
-        self.inputs = []
+    def __init__(self, capacity=1024):
+        self._capacity = capacity
+        self._history = None
+
         self.Cg_in = 314.19206 / 180  # (g/L) / (g/mol) = mol/L
         self.G_rpm_to_ml_min = 0.02117909  # (ml/min) / (rpm)
 
@@ -121,6 +188,19 @@ class LabviewInputs:
         self.T_amb = 25
         self.Q_fact = 1
 
+        self.offsets = numpy.array([0.004422699015892, 0.004053967439397, 0.004, 0.004, 0.004,
+                                    0.004, 0.004, 0.004, 0.004, 0.004, 0, 0])
+        self.spans = numpy.array([0.0004717700792543, 9.925512172352e-5, 4e-5, 0.000542, 4e-5,
+                                  0.00032, 0.00064, 0.0008, 1, 1])
+
+    @property
+    def ts(self):
+        return self._history.ts if self._history is not None else numpy.zeros(0)
+
+    @property
+    def inputs(self):
+        return self._history.view('raw') if self._history is not None else numpy.zeros((0, 0))
+
     def update(self, t, data):
         """Update the current inputss
 
@@ -131,15 +211,26 @@ class LabviewInputs:
         data : array_like
             Current inputs
         """
-        self.ts.append(t)
-        self.inputs.append(data)
+        data = numpy.asarray(data, dtype=float)
+        if self._history is None:
+            self._history = history.History([('raw', data.shape), ('inputs', (15,))], self._capacity)
+        self._history.append(t, raw=data, inputs=self._engineering_units(data))
 
-    def __call__(self, t):
-        offsets = [0.004422699015892, 0.004053967439397, 0.004, 0.004, 0.004, 0.004, 0.004, 0.004, 0.004, 0.004, 0, 0]
-        spans = [0.0004717700792543, 9.925512172352e-5, 4e-5, 0.000542, 4e-5, 0.00032, 0.00064, 0.0008, 1, 1]
+    def _engineering_units(self, data):
+        """Converts raw Labview channels to model inputs
 
-        index = min(numpy.searchsorted(self.ts, t), len(self.ts)-1)
-        ins = [(in_i - offset)/span for in_i, offset, span in zip(self.inputs[index], offsets, spans)]
+        Parameters
+        ----------
+        data : array_like
+            Raw inputs
+
+        Returns
+        -------
+        inputs : tuple
+            The model inputs
+        """
+        n_channels = len(self.spans)
+        ins = ((data[:n_channels] - self.offsets[:n_channels]) / self.spans).tolist()
         CO2_ml_min, O2_ml_min, _, B_rpm, _, M_rpm, G_rpm, N_rpm, B_on_off, Q_on_off = ins
 
         Cg_in = self.Cg_in
@@ -169,15 +260,17 @@ class LabviewInputs:
 
         return Fg_in, Cg_in, Fco_in, Cco_in, Fo_in, Co_in, Fg_out, Cn_in, Fn_in, Fb_in, Cb_in, Fm_in, F_out, T_amb, Q
 
+    def __call__(self, t):
+        index = min(self._history.searchsorted(t), len(self._history) - 1)
+        return tuple(self._history.get('inputs', index).tolist())
+
     def get_data(self):
         """Get all the input data
 
         Returns
         -------
         out : array_like
-            All the input data
+            All the input data with the time stamps in the first column
         """
-        ts = numpy.array(self.ts)
-        inputs = numpy.array(self.inputs)
-        out = numpy.concatenate([ts, inputs])
+        out = numpy.concatenate([self.ts[:, numpy.newaxis], self.inputs], axis=1)
         return out
@@ -0,0 +1,486 @@
+# Contains the Kalman filter implementations used by the state estimator
+import numpy
+import scipy.linalg
+
+
+class UnscentedKalmanFilter:
+    """A UKF that reuses preallocated buffers on every predict and update.
+    The predict and update steps behave like those of `filterpy.kalman.UnscentedKalmanFilter`,
+    including the use of the sigma points of the most recent predict in an update.
+    The measurement function is called once with all the sigma points stacked,
+    and the gain is solved with a Cholesky factorisation of the innovation covariance
+
+    Parameters
+    ----------
+    dim_x : int
+        The number of states
+
+    dim_z : int
+        The number of measurements
+
+    hx : callable
+        The measurement function.
+        Must take in an array of states with one state per row and return the measurements, one row per state
+
+    propagator : {propagators.SerialPropagator, propagators.PoolPropagator}
+        Propagates the sigma points through the state transition function
+
+    points : MerweScaledSigmaPoints
+        A sigma point generating object
+
+    Attributes
+    ----------
+    x : array_like
+        The state estimate.
+        This is a buffer of the filter, which later steps overwrite
+
+    P : 2d array_like
+        The covariance.
+        This is a buffer of the filter, which later steps overwrite
+
+    Q, R : 2d array_like
+        The process and measurement noise covariances
+
+    sigmas_f : 2d array_like
+        The sigma points after the most recent predict
+
+    sigmas_h : 2d array_like
+        The measurements of `sigmas_f` in the most recent update
+
+    K : 2d array_like
+        The gain of the most recent update
+    """
+    def __init__(self, dim_x, dim_z, hx, propagator, points):
+        self.dim_x = dim_x
+        self.dim_z = dim_z
+        self.hx = hx
+        self.propagator = propagator
+        self.points = points
+        self.Wm = points.Wm
+        self._Wc = points.Wc[:, numpy.newaxis]
+
+        n_sigmas = points.num_sigmas()
+        self._x = numpy.zeros(dim_x)
+        self._P = numpy.eye(dim_x)
+        self.Q = numpy.eye(dim_x)
+        self.R = numpy.eye(dim_z)
+
+        self.sigmas_f = numpy.zeros((n_sigmas, dim_x))
+        self.sigmas_h = numpy.zeros((n_sigmas, dim_z))
+        self.K = numpy.zeros((dim_x, dim_z))
+
+        # Workspace
+        self._dx = numpy.empty((n_sigmas, dim_x))
+        self._weighted_x = numpy.empty((n_sigmas, dim_x))
+        self._dz = numpy.empty((n_sigmas, dim_z))
+        self._weighted_z = numpy.empty((n_sigmas, dim_z))
+        self._zp = numpy.empty(dim_z)
+        self._S = numpy.empty((dim_z, dim_z))
+        self._Pxz = numpy.empty((dim_x, dim_z))
+        self._KS = numpy.empty((dim_x, dim_z))
+        self._KSK = numpy.empty((dim_x, dim_x))
+
+    @property
+    def x(self):
+        return self._x
+
+    @x.setter
+    def x(self, value):
+        self._x[:] = value
+
+    @property
+    def P(self):
+        return self._P
+
+    @P.setter
+    def P(self, value):
+        self._P[:] = value
+
+    def predict(self, dt):
+        """Propagates the state and the covariance
+
+        Parameters
+        ----------
+        dt : float
+            The time step
+        """
+        sigmas = self.points.sigma_points(self._x, self._P)
+        self.propagator(sigmas, dt, self.sigmas_f)
+
+        self._transform(self.sigmas_f, self.Q, self._x, self._P, self._dx, self._weighted_x)
+
+    def update(self, z):
+        """Updates the state and the covariance with a measurement.
+        As in filterpy, the sigma points of the most recent predict are used
+
+        Parameters
+        ----------
+        z : array_like
+            The measurement
+        """
+        self.sigmas_h[:] = self.hx(self.sigmas_f)
+        self._transform(self.sigmas_h, self.R, self._zp, self._S, self._dz, self._weighted_z)
+
+        numpy.subtract(self.sigmas_f, self._x, out=self._dx)
+        numpy.dot(self._dx.T, self._weighted_z, out=self._Pxz)
+
+        # K = Pxz @ inv(S), with S symmetric positive definite
+        self.K[:] = scipy.linalg.cho_solve(scipy.linalg.cho_factor(self._S), self._Pxz.T).T
+
+        self._x += self.K @ (numpy.asarray(z) - self._zp)
+        numpy.dot(self.K, self._S, out=self._KS)
+        numpy.dot(self._KS, self.K.T, out=self._KSK)
+        self._P -= self._KSK
+
+    def _transform(self, sigmas, noise, mean, covariance, deviations, weighted):
+        """The unscented transform, written into the given buffers
+
+        Parameters
+        ----------
+        sigmas : 2d array_like
+            Transformed sigma points, one per row
+
+        noise : 2d array_like
+            The added noise covariance
+
+        mean, covariance : array_like
+            Buffers for the weighted mean and covariance of the sigma points
+
+        deviations, weighted : 2d array_like
+            Buffers for the deviations of the sigma points from the mean, unweighted and weighted
+        """
+        numpy.dot(self.Wm, sigmas, out=mean)
+        numpy.subtract(sigmas, mean, out=deviations)
+        numpy.multiply(self._Wc, deviations, out=weighted)
+        numpy.dot(deviations.T, weighted, out=covariance)
+        covariance += noise
+
+
+class SquareRootUnscentedKalmanFilter:
+    """A square root UKF following Van der Merwe and Wan (2001).
+    Instead of the covariance P, the filter keeps an upper triangular factor S with S.T @ S = P.
+    The factor is propagated with QR decompositions and rank-one Cholesky updates,
+    so no matrix square root is taken on a predict and the covariance stays positive definite.
+    The predict and update steps otherwise behave like those of :class:`UnscentedKalmanFilter`
+
+    Parameters
+    ----------
+    dim_x : int
+        The number of states
+
+    dim_z : int
+        The number of measurements
+
+    hx : callable
+        The measurement function.
+        Must take in an array of states with one state per row and return the measurements, one row per state
+
+    propagator : {propagators.SerialPropagator, propagators.PoolPropagator}
+        Propagates the sigma points through the state transition function
+
+    points : MerweScaledSigmaPoints
+        A sigma point generating object
+
+    Attributes
+    ----------
+    x : array_like
+        The state estimate
+
+    S : 2d array_like
+        The upper triangular square root of the covariance
+
+    P : 2d array_like
+        The covariance, calculated from `S`.
+        Setting it refactors `S`
+
+    Q, R : 2d array_like
+        The process and measurement noise covariances
+
+    sigmas_f : 2d array_like
+        The sigma points after the most recent predict
+
+    refactorizations : int
+        The number of times `S` had to be rebuilt from P because a downdate failed
+    """
+    def __init__(self, dim_x, dim_z, hx, propagator, points):
+        self.dim_x = dim_x
+        self.dim_z = dim_z
+        self.hx = hx
+        self.propagator = propagator
+        self.points = points
+        self.Wm, self.Wc = points.Wm, points.Wc
+
+        self.x = numpy.zeros(dim_x)
+        self.S = numpy.eye(dim_x)
+        self.Q = numpy.eye(dim_x)
+        self.R = numpy.eye(dim_z)
+
+        self.sigmas_f = numpy.zeros((points.num_sigmas(), dim_x))
+        self.refactorizations = 0
+
+    @property
+    def x(self):
+        return self._x
+
+    @x.setter
+    def x(self, value):
+        self._x = numpy.array(value, dtype=float)
+
+    @property
+    def P(self):
+        return self.S.T @ self.S
+
+    @P.setter
+    def P(self, value):
+        self.S = _triangular_sqrt(value)
+
+    @property
+    def Q(self):
+        return self._Q
+
+    @Q.setter
+    def Q(self, value):
+        self._Q = numpy.array(value, dtype=float)
+        self._sqrt_Q = _triangular_sqrt(self._Q)
+
+    @property
+    def R(self):
+        return self._R
+
+    @R.setter
+    def R(self, value):
+        self._R = numpy.array(value, dtype=float)
+        self._sqrt_R = _triangular_sqrt(self._R)
+
+    def predict(self, dt):
+        """Propagates the state and the covariance factor
+
+        Parameters
+        ----------
+        dt : float
+            The time step
+        """
+        sigmas = self.points.sigma_points_from_sqrt(self.x, self.S)
+        self.propagator(sigmas, dt, self.sigmas_f)
+
+        self.x, self.S = self._transform(self.sigmas_f, self._sqrt_Q)
+
+    def update(self, z):
+        """Updates the state and the covariance factor with a measurement.
+        As in filterpy, the sigma points of the most recent predict are used
+
+        Parameters
+        ----------
+        z : array_like
+            The measurement
+        """
+        sigmas_h = self.hx(self.sigmas_f)
+        zp, Sz = self._transform(sigmas_h, self._sqrt_R)
+
+        Pxz = (self.Wc[:, numpy.newaxis] * (self.sigmas_f - self.x)).T @ (sigmas_h - zp)
+        # K = Pxz @ inv(Sz.T @ Sz), solved with the triangular factor
+        K = scipy.linalg.solve_triangular(Sz, scipy.linalg.solve_triangular(Sz, Pxz.T, trans='T')).T
+
+        self.x = self.x + K @ (numpy.asarray(z) - zp)
+        for u in (K @ Sz.T).T:
+            self._downdate(u)
+
+    def _transform(self, sigmas, sqrt_noise):
+        """The unscented transform in square root form
+
+        Parameters
+        ----------
+        sigmas : 2d array_like
+            Transformed sigma points, one per row
+
+        sqrt_noise : 2d array_like
+            The square root of the added noise covariance
+
+        Returns
+        -------
+        mean : array_like
+            The weighted mean of the sigma points
+
+        S : 2d array_like
+            The upper triangular square root of the covariance
+        """
+        mean = self.Wm @ sigmas
+        deviations = sigmas - mean
+        compound = numpy.vstack([numpy.sqrt(self.Wc[1:, numpy.newaxis]) * deviations[1:], sqrt_noise])
+        S = _positive_diagonal(scipy.linalg.qr(compound, mode='r')[0][:len(mean)])
+
+        if self.Wc[0] > 0:
+            S = _cholupdate(S, numpy.sqrt(self.Wc[0]) * deviations[0])
+        elif self.Wc[0] < 0:
+            S = self._downdated(S, numpy.sqrt(-self.Wc[0]) * deviations[0])
+        return mean, S
+
+    def _downdate(self, v):
+        """Removes v v^T from the covariance"""
+        self.S = self._downdated(self.S, v)
+
+    def _downdated(self, S, v):
+        """Returns the factor of S.T @ S - v v^T.
+        If the result is not positive definite, the factor is rebuilt from the clipped covariance"""
+        try:
+            return _choldowndate(S, v)
+        except numpy.linalg.LinAlgError:
+            self.refactorizations += 1
+            return _triangular_sqrt(S.T @ S - numpy.outer(v, v))
+
+
+class ExtendedKalmanFilter:
+    """An EKF that propagates a single state and linearizes the dynamics around it.
+    The predict and update steps are first order versions of those of :class:`UnscentedKalmanFilter`.
+    In particular, an update uses the covariance propagated by the most recent predict without the process noise,
+    just as the UKFs use the sigma points of the most recent predict
+
+    Parameters
+    ----------
+    dim_x : int
+        The number of states
+
+    dim_z : int
+        The number of measurements
+
+    hx : callable
+        The measurement function. Must take in a state and return the measurements
+
+    HJacobian : callable
+        Must take in a state and return the Jacobian of `hx` with shape (dim_z, dim_x)
+
+    fx : callable
+        The state transition function. Must take in a state and a time step and return the new state
+
+    FJacobian : callable
+        Must take in a state and a time step and return the Jacobian of `fx` with respect to the state
+
+    spread : float, optional
+        Scales the propagated covariance.
+        The weights of :class:`AdjMerweScaledSigmaPoints.MerweScaledSigmaPoints` scale it by `alpha**2`,
+        so passing `alpha**2` linearizes the same filter as a UKF with those sigma points.
+        Defaults to 1, which is the standard EKF
+
+    Attributes
+    ----------
+    x : array_like
+        The state estimate
+
+    P : 2d array_like
+        The covariance
+
+    Q, R : 2d array_like
+        The process and measurement noise covariances
+
+    F : 2d array_like
+        The state transition Jacobian of the most recent predict
+
+    P_f : 2d array_like
+        The covariance propagated by the most recent predict, without the process noise
+
+    K : 2d array_like
+        The gain of the most recent update
+    """
+    def __init__(self, dim_x, dim_z, hx, HJacobian, fx, FJacobian, spread=1.):
+        self.dim_x = dim_x
+        self.dim_z = dim_z
+        self.hx = hx
+        self.HJacobian = HJacobian
+        self.fx = fx
+        self.FJacobian = FJacobian
+        self.spread = spread
+
+        self.x = numpy.zeros(dim_x)
+        self.P = numpy.eye(dim_x)
+        self.Q = numpy.eye(dim_x)
+        self.R = numpy.eye(dim_z)
+
+        self.F = numpy.eye(dim_x)
+        self.P_f = numpy.eye(dim_x)
+        self.K = numpy.zeros((dim_x, dim_z))
+
+    @property
+    def x(self):
+        return self._x
+
+    @x.setter
+    def x(self, value):
+        self._x = numpy.array(value, dtype=float)
+
+    @property
+    def P(self):
+        return self._P
+
+    @P.setter
+    def P(self, value):
+        self._P = numpy.array(value, dtype=float)
+
+    def predict(self, dt):
+        """Propagates the state through `fx` and the covariance through its Jacobian
+
+        Parameters
+        ----------
+        dt : float
+            The time step
+        """
+        self.F = self.FJacobian(self._x, dt)
+        self._x = numpy.asarray(self.fx(self._x, dt), dtype=float)
+        self.P_f = self.spread * self.F @ self._P @ self.F.T
+        self._P = self.P_f + self.Q
+
+    def update(self, z):
+        """Updates the state and the covariance with a measurement
+
+        Parameters
+        ----------
+        z : array_like
+            The measurement
+        """
+        H = self.HJacobian(self._x)
+        Pxz = self.P_f @ H.T
+        S = H @ Pxz + self.R
+
+        # K = Pxz @ inv(S), with S symmetric positive definite
+        self.K = scipy.linalg.cho_solve(scipy.linalg.cho_factor(S), Pxz.T).T
+
+        self._x = self._x + self.K @ (numpy.asarray(z) - self.hx(self._x))
+        self._P = self._P - self.K @ S @ self.K.T
+
+
+def _positive_diagonal(S):
+    """Flips the signs of rows of an upper triangular factor so that its diagonal is not negative"""
+    return S * numpy.where(numpy.diag(S) < 0, -1, 1)[:, numpy.newaxis]
+
+
+def _cholupdate(S, v):
+    """Returns the upper triangular factor of S.T @ S + v v^T"""
+    return _positive_diagonal(scipy.linalg.qr(numpy.vstack([S, v]), mode='r')[0][:len(v)])
+
+
+def _choldowndate(S, v):
+    """Returns the upper triangular factor of S.T @ S - v v^T.
+    Raises `numpy.linalg.LinAlgError` if the result is not positive definite"""
+    S = S.copy()
+    v = numpy.array(v, dtype=float)
+    for k in range(len(v)):
+        r2 = S[k, k]**2 - v[k]**2
+        if not r2 > 0:
+            raise numpy.linalg.LinAlgError("Downdate is not positive definite")
+        r = numpy.sqrt(r2)
+        c, s = r / S[k, k], v[k] / S[k, k]
+        S[k, k] = r
+        S[k, k+1:] = (S[k, k+1:] - s * v[k+1:]) / c
+        v[k+1:] = c * v[k+1:] - s * S[k, k+1:]
+    return S
+
+
+def _triangular_sqrt(P):
+    """Returns an upper triangular S with S.T @ S = P.
+    Uses a Cholesky decomposition, or a clipped eigendecomposition if P is not positive definite"""
+    P = numpy.asarray(P, dtype=float)
+    try:
+        return scipy.linalg.cholesky(P)
+    except numpy.linalg.LinAlgError:
+        w, V = numpy.linalg.eigh((P + P.T) / 2)
+        root = numpy.sqrt(numpy.clip(w, 0, None))[:, numpy.newaxis] * V.T
+        return _positive_diagonal(scipy.linalg.qr(root, mode='r')[0])
@@ -3,9 +3,14 @@ import inputters
 import stateUpdaters
 import Model
 import StateEstimator
+import numpy
 import scipy.stats
 import matplotlib.pyplot as plt
 import plotting
+import timing
+import downsampling
+import results
+import time
 
 
 class Labview:
@@ -17,7 +22,11 @@ class Labview:
         The current time
 
     ts : array_like
-        List of times
+        List of times, from the row `ts_offset` onwards.
+        The times of rows that the model has freed are dropped in :func:`step`
+
+    ts_offset : int
+        The index of the row of the first time in `ts`
 
     inputs : inputters.LabviewInputs
         Input object that stores and retrieves inputs
@@ -37,16 +46,44 @@ class Labview:
     t_predict : float
         The period between state predictions
 
+    max_backdate : float
+        The furthest into the past, in hours, that an update can be backdated.
+        Older rows are freed once they are written, see `keep_rows`
+
     se : StateEstimator.StateEstimator
         State estimator object
 
     live_plot : bool
         If `True` then a live plot of the run is shown
 
+    plot : plotting.LivePlot
+        The live plot, if it is shown
+
+    timer : timing.LatencyTimer
+        Records the latency of each phase of :func:`step`, see :func:`get_timings`
+
+    graph_points : int
+        The most points in each line of :func:`get_glucose_graph`
+
+    graph : dict
+        The downsampled lines of :func:`get_glucose_graph`, by name
+
+    results_path : string
+        The directory to which the results of the session are streamed.
+        Defaults to a time stamped directory in `results`
+
+    keep_rows : int
+        The number of written rows that the model and state estimator keep in memory,
+        see :class:`results.ResultWriter`
+
+    writer : results.ResultWriter
+        Streams the results of the session to disk between :func:`init` and :func:`finalise`
+
     """
     def __init__(self):
         self.t = 0
         self.ts = [self.t]
+        self.ts_offset = 0
 
         self.inputs = inputters.LabviewInputs()
         self.su = stateUpdaters.LabviewStateUpdate()
@@ -57,31 +94,50 @@ class Labview:
 
         # State estimation
         self.t_predict = 0.9/3600
-        self.se = StateEstimator.StateEstimator(self.X0, self.inputs, self.t_predict)
+        self.max_backdate = 2
+        self.timer = timing.LatencyTimer()
+        self.se = StateEstimator.StateEstimator(self.X0, self.inputs, self.t_predict,
+                                                max_backdate=self.max_backdate, timer=self.timer)
 
         # Plotting
         self.live_plot = True
+        self.plot = None
+
+        # LabVIEW graphs
+        self.graph_points = 1000
+        self.graph = {name: downsampling.MinMaxDownsampler(self.graph_points) for name in ['Cg_m', 'Cg+', 'Cg-']}
+        self._graph_revision = 0
+        self._graph_confidence = None
+
+        # Results
+        self.results_path = time.strftime('results/labview_%Y%m%d_%H%M%S')
+        self.keep_rows = 3600
+        self.writer = None
 
 
 lv = Labview()
 
 if lv.live_plot:
-    plt.figure(figsize=(20, 20))
     plt.ion()
+    lv.plot = plotting.LivePlot(figure=plt.figure(figsize=(20, 20)))
 
 
 def init():
     """ Initialises the labview interface.
-    Called before the while loop in labview
+    Called before the while loop in labview.
+    Starts streaming the results to `lv.results_path`
     """
-    pass
+    lv.writer = results.ResultWriter(lv.results_path, lv.m, lv.se, lv.su, keep_rows=lv.keep_rows)
 
 
 def finalise():
     """Ends the labview interface.
-    Called after the while loop in labview
+    Called after the while loop in labview.
+    Writes the remaining results to disk
     """
-    pass
+    if lv.writer is not None:
+        lv.writer.close()
+        lv.writer = None
 
 
 def update_inputs(t, inputs):
@@ -99,26 +155,41 @@ def update_inputs(t, inputs):
 
 
 def step(t):
-    """Steps the labview object through time
+    """Steps the labview object through time.
+    The duration of each phase is recorded by `lv.timer`, see :func:`get_timings`
 
     Parameters
     ----------
     t : float
         Current time
     """
-    dt = t - lv.t
-    lv.t = t
-    lv.ts.append(t)
-    lv.m.step(dt)
-    lv.se.step(dt)
-    lv.su.step(dt)
-    if lv.su.update_ready():
-        t_u, z = lv.su.get_update()
-        lv.se.update(z, t-t_u)
-        lv.su.update = False
-        
-    if lv.live_plot:
-        plotting.plot_live(lv.ts, lv.m, lv.se, lv.su)
+    timer = lv.timer
+    with timer.phase('step'):
+        dt = t - lv.t
+        lv.t = t
+        lv.ts.append(t)
+        with timer.phase('model_step'):
+            lv.m.step(dt)
+        lv.se.step(dt)
+        lv.su.step(dt)
+        if lv.su.update_ready():
+            t_u, z = lv.su.get_update()
+            lv.se.update(z, t-t_u)
+            lv.su.update = False
+
+        if lv.writer is not None:
+            with timer.phase('write'):
+                if lv.writer.step():
+                    timer.count('flushes')
+                    # The times of the rows that the model freed are dropped with them
+                    del lv.ts[:lv.m.offset - lv.ts_offset]
+                    lv.ts_offset = lv.m.offset
+
+        if lv.live_plot:
+            with timer.phase('plot'):
+                if lv.plot.update(lv.ts, lv.m, lv.se, lv.su, ts_offset=lv.ts_offset):
+                    timer.count('frames')
+    timer.count('steps')
 
 
 def update_state(t, z):
@@ -138,35 +209,94 @@ def update_state(t, z):
 
 
 def get_glucose_graph(confidence=0.95):
-    """ Passes outputs to labview from the model
+    """ Passes outputs to labview from the model.
+    The model and state estimator lines are downsampled to at most `lv.graph_points` points,
+    keeping the smallest and largest value in each stretch of time, see :class:`downsampling.MinMaxDownsampler`.
+    Only the rows that are new since the previous call, or that a backdated update rewrote, are processed
 
     Parameters
     ----------
     confidence : float
         The confidence probability for the plots
     """
-    model = lv.m.get_data()
-    se = lv.se.get_data()
-    su = lv.su.get_data().values
+    graph = lv.graph
+    # The model and estimator may have freed their oldest rows, see results.ResultWriter
+    model = lv.m.get_Xs()
+    ts_m = lv.m.get_ts()
+    model_offset = lv.m.offset
+    n = model_offset + len(model)
 
-    ts = lv.ts
     # Model
-    Vs_m = model[:, 11]
-    Cgs_m = model[:, 0] * 180 / Vs_m
+    start = max(graph['Cg_m'].n, model_offset)
+    rows = slice(start - model_offset, None)
+    graph['Cg_m'].extend(ts_m[rows], model[rows, 0] * 180 / model[rows, 11], start)
 
-    # State estimator
-    Vs = se[:, 11]
-    Cgs = se[:, 0] * 180 / Vs_m
+    # State estimator, from the first row that a backdated update rewrote
+    se = lv.se.get_data()
+    ts_se = lv.se.ts
+    se_offset = lv.se.offset
+    start = lv.se.first_changed(lv._graph_revision)
+    lv._graph_revision = lv.se.revision
+    if confidence != lv._graph_confidence:
+        lv._graph_confidence = confidence
+        start = 0
 
     # Standard deviation multiplier to get the correct confidence interval
     K = scipy.stats.norm.ppf(confidence)
-    # SE covs
-    Pgs = se[:, 14 + 0] * 180 / Vs * K
+    stop = min(se_offset + len(se), n)
+    for name, sign in [('Cg+', 1), ('Cg-', -1)]:
+        # A bucket that begins before the freed rows is rebuilt from the rows still in memory
+        first = max(graph[name].rewind(start), se_offset, model_offset)
+        rows = slice(first - se_offset, stop - se_offset)
+        Cgs = se[rows, 0] * 180 / model[first - model_offset:stop - model_offset, 11]
+        Pgs = se[rows, 14 + 0] * 180 / se[rows, 11] * K
+        graph[name].extend(ts_se[rows], Cgs + sign*Pgs, first)
 
     # Measured update values
+    su = lv.su.get_data()
     ts_meas = lv.su.get_times()
-    Cg_meas = su[:, 0][:len(ts_meas)]
+    Cg_meas = su[:, 0][:len(ts_meas)] if len(ts_meas) else numpy.zeros(0)
 
-    plots = [(ts, Cgs_m), (ts, Cgs + Pgs), (ts, Cgs - Pgs), (ts_meas, Cg_meas)]
+    plots = [graph['Cg_m'].points(), graph['Cg+'].points(), graph['Cg-'].points(), (ts_meas, Cg_meas)]
 
     return plots
+
+
+def get_timings():
+    """Passes the latency statistics of :func:`step` to labview.
+    The phases are `'step'` (the whole call), `'model_step'`, `'se_predict'`,
+    `'propagation'` (of the sigma points, part of `'se_predict'` and `'se_replay'`),
+    `'se_update'` (including the replays of a backdated update), `'se_replay'`, `'write'` and `'plot'`.
+    The counters are `'steps'`, `'predicts'`, `'updates'`, `'replayed_predicts'`, `'flushes'` and `'frames'` (drawn)
+
+    Returns
+    -------
+    phases : list
+        A `(name, count, p50, p95, max)` tuple for each phase that has run, with the times in milliseconds.
+        The percentiles are over the most recent calls, the maximum over all of them
+
+    counters : list
+        A `(name, value)` tuple for each counter
+    """
+    summary = lv.timer.summary()
+    phases = [(name, stats['count'], stats['p50']*1e3, stats['p95']*1e3, stats['max']*1e3)
+              for name, stats in summary['phases'].items()]
+    counters = list(summary['counters'].items())
+    return phases, counters
+
+
+def dump_timings(filename='results/timings.json'):
+    """Writes the latency statistics of :func:`step` to a JSON file, see :meth:`timing.LatencyTimer.dump`
+
+    Parameters
+    ----------
+    filename : string, optional
+        The name of the file.
+        Defaults to `'results/timings.json'`
+    """
+    lv.timer.dump(filename)
+
+
+def reset_timings():
+    """Forgets the latency statistics of :func:`step`, e.g. after the start up transient"""
+    lv.timer.reset()
@@ -1,19 +1,22 @@
+import time
 import matplotlib.pyplot as plt
-import pandas
+import numpy
 import scipy.stats
 import Model
+import results
+import downsampling
 import StateEstimator
 import stateUpdaters
 
 
 # noinspection DuplicatedCode
-def plot_all(file_name, confidence=0.95, show=True):
+def plot_all(file_name, confidence=0.95, show=True, max_points=2000):
     """Plots all the graphs from a file
 
     Parameters
     ----------
     file_name : string
-        The name of the file in which all the data is stored
+        The name of the file in which all the data is stored, see :func:`results.load`
 
     confidence : float, optional
         The confidence probability for the plots
@@ -23,11 +26,15 @@ def plot_all(file_name, confidence=0.95, show=True):
         If `True` then the plt.show method is called at the end.
         Useful to turn off when you want to add additional things
         Defaults to `True`
+
+    max_points : int, optional
+        The most points drawn in each line, see :func:`downsampling.min_max`.
+        Defaults to 2000
     """
-    xls = pandas.ExcelFile(file_name)
-    model = pandas.read_excel(xls, 'model')
-    se = pandas.read_excel(xls, 'se')
-    su = pandas.read_excel(xls, 'su')
+    sections = results.load(file_name)
+    model = sections['model']
+    se = sections['se']
+    su = sections['su']
 
     # Model
     ts_m = model['ts']
@@ -66,42 +73,45 @@ def plot_all(file_name, confidence=0.95, show=True):
     Cfa_meas = su['Cfa']
     Ce_meas = su['Ce']
 
+    def plot(x, y, *args, **kwargs):
+        plt.plot(*downsampling.min_max(x, y, max_points), *args, **kwargs)
+
     plt.figure(figsize=(20, 20))
     plt.rc("font", size=20)
     plt.subplot(2, 2, 1)
-    plt.plot(ts_m, Cgs_m, "--")
-    plt.plot(ts_m, Cgs, "-.")
-    plt.plot(ts, Cgs + Pgs, 'tab:purple')
-    plt.plot(ts, Cgs - Pgs, 'tab:purple')
+    plot(ts_m, Cgs_m, "--")
+    plot(ts_m, Cgs, "-.")
+    plot(ts, Cgs + Pgs, 'tab:purple')
+    plot(ts, Cgs - Pgs, 'tab:purple')
     plt.plot(ts_meas, Cg_meas, '.')
     plt.title("Glucose")
 
     plt.subplot(2, 2, 2)
-    plt.plot(ts_m, Cfas_m, "--")
-    plt.plot(ts_m, Cfas, "-.")
-    plt.plot(ts, Cfas + Pfas, 'tab:purple')
-    plt.plot(ts, Cfas - Pfas, 'tab:purple')
+    plot(ts_m, Cfas_m, "--")
+    plot(ts_m, Cfas, "-.")
+    plot(ts, Cfas + Pfas, 'tab:purple')
+    plot(ts, Cfas - Pfas, 'tab:purple')
     plt.plot(ts_meas, Cfa_meas, '.')
     plt.title("Fumaric")
 
     plt.subplot(2, 2, 3)
-    plt.plot(ts_m, Ces_m, "--")
-    plt.plot(ts_m, Ces, "-.")
-    plt.plot(ts, Ces + Pes, 'tab:purple')
-    plt.plot(ts, Ces - Pes, 'tab:purple')
+    plot(ts_m, Ces_m, "--")
+    plot(ts_m, Ces, "-.")
+    plot(ts, Ces + Pes, 'tab:purple')
+    plot(ts, Ces - Pes, 'tab:purple')
     plt.plot(ts_meas, Ce_meas, '.')
     plt.title("Ethanol")
 
     plt.subplot(2, 2, 4)
-    plt.plot(ts_m, Czs_m, "--")
-    plt.plot(ts_m, Czs, "-.")
-    plt.plot(ts, Czs + Pzs, 'tab:purple', label="Z")
-    plt.plot(ts, Czs - Pzs, 'tab:purple')
-
-    plt.plot(ts_m, Cys_m, "--")
-    plt.plot(ts_m, Cys_m, "-.")
-    plt.plot(ts, Cys + Pys, 'tab:pink', label="Y")
-    plt.plot(ts, Cys - Pys, 'tab:pink')
+    plot(ts_m, Czs_m, "--")
+    plot(ts_m, Czs, "-.")
+    plot(ts, Czs + Pzs, 'tab:purple', label="Z")
+    plot(ts, Czs - Pzs, 'tab:purple')
+
+    plot(ts_m, Cys_m, "--")
+    plot(ts_m, Cys_m, "-.")
+    plot(ts, Cys + Pys, 'tab:pink', label="Y")
+    plot(ts, Cys - Pys, 'tab:pink')
     plt.title("Enzyme")
     plt.legend()
 
@@ -120,12 +130,286 @@ def plot_all(file_name, confidence=0.95, show=True):
         plt.show()
 
 
+class LivePlot:
+    """A live plot of a run that is updated incrementally.
+    The lines are created once, and each frame only converts the rows that are new since the previous frame,
+    or that a backdated update of the state estimator rewrote,
+    and each line is downsampled to at most `max_points` points with :class:`downsampling.MinMaxDownsampler`.
+    Axis limits are only changed when the data leaves them, with some headroom,
+    and frames are drawn at most `max_fps` times per second,
+    so that the cost of a frame does not grow with the length of the run.
+    The first three rows are not plotted
+
+    Parameters
+    ----------
+    confidence : float, optional
+        The confidence probability for the plots.
+        Defaults to 95%
+
+    max_fps : float, optional
+        The most frames that are drawn per second.
+        Calls to :meth:`update` in between frames return immediately.
+        Defaults to 2
+
+    figure : matplotlib.figure.Figure, optional
+        The figure to draw in.
+        Defaults to the current figure
+
+    max_points : int, optional
+        The most points drawn in each line.
+        Defaults to 2000
+
+    Attributes
+    ----------
+    figure : matplotlib.figure.Figure
+        The figure drawn in
+
+    confidence : float
+        The confidence probability for the plots
+
+    max_fps : float
+        The most frames that are drawn per second
+
+    max_points : int
+        The most points drawn in each line
+
+    frames : int
+        The number of frames that have been drawn
+    """
+    # The columns of the plotted data, by line.
+    # Model lines hold the model value and estimator lines the upper and lower confidence bounds
+    _MODEL = ['Cg', 'Cfa', 'Ce', 'Cz', 'Cy', 'T', 'pH']
+    _SE = ['Cg+', 'Cg-', 'Cfa+', 'Cfa-', 'Ce+', 'Ce-', 'Cz+', 'Cz-', 'Cy+', 'Cy-', 'T+', 'T-']
+    _SKIP = 3
+
+    def __init__(self, confidence=0.95, max_fps=2., figure=None, max_points=2000):
+        self.figure = plt.gcf() if figure is None else figure
+        self.figure.clear()
+        self.confidence = confidence
+        self.max_fps = max_fps
+        self.max_points = max_points
+        self.frames = 0
+        self._K = scipy.stats.norm.ppf(confidence)
+        self._last_draw = -numpy.inf
+        self._sources = None
+
+        axes = [self.figure.add_subplot(3, 2, i + 1) for i in range(6)]
+        self._axes = axes
+        self._lines = {}
+        for ax, name, title in zip(axes, ['Cg', 'Cfa', 'Ce'], ["Glucose", "Fumaric", "Ethanol"]):
+            self._lines['m_' + name], = ax.plot([], [], "--")
+            self._lines[name + '+'], = ax.plot([], [])
+            self._lines[name + '-'], = ax.plot([], [])
+            self._lines['meas_' + name], = ax.plot([], [], '.')
+            ax.set_title(title)
+
+        self._lines['m_Cz'], = axes[3].plot([], [], "--")
+        self._lines['Cz+'], = axes[3].plot([], [], label="Z+")
+        self._lines['Cz-'], = axes[3].plot([], [], label="Z-")
+        self._lines['m_Cy'], = axes[3].plot([], [], "--")
+        self._lines['Cy+'], = axes[3].plot([], [], label="Y+")
+        self._lines['Cy-'], = axes[3].plot([], [], label="Y-")
+        axes[3].set_title("Enzyme")
+        axes[3].legend()
+
+        self._lines['m_T'], = axes[4].plot([], [], "--")
+        self._lines['T+'], = axes[4].plot([], [])
+        self._lines['T-'], = axes[4].plot([], [])
+        axes[4].set_title("Temperature")
+
+        self._lines['m_pH'], = axes[5].plot([], [])
+        axes[5].set_title("pH")
+
+        self._reset()
+
+    def _reset(self):
+        """Forgets all the plotted data"""
+        self._columns = {name: i for i, name in enumerate(['t'] + self._MODEL + self._SE)}
+        self._data = numpy.full((len(self._columns), 1024), numpy.nan)
+        self._downsamplers = {name: downsampling.MinMaxDownsampler(self.max_points)
+                              for name in self._lines if not name.startswith('meas_')}
+        self._offset = 0
+        self._n_model = 0
+        self._n_se = 0
+        self._se_revision = 0
+        self._n_meas = -1
+        self._limits = {ax: [numpy.inf, -numpy.inf, numpy.inf, -numpy.inf] for ax in self._axes}
+
+    def _reserve(self, n):
+        """Makes space for the rows of plotted data up to index `n`"""
+        capacity = self._data.shape[1]
+        if n - self._offset > capacity:
+            while n - self._offset > capacity:
+                capacity *= 2
+            data = numpy.full((self._data.shape[0], capacity), numpy.nan)
+            data[:, :self._data.shape[1]] = self._data
+            self._data = data
+
+    def _discard(self, n):
+        """Frees the rows of plotted data before index `n`.
+        The rows are only moved once half of the space can be freed, so that moving them is amortized O(1)"""
+        k = n - self._offset
+        if k < self._data.shape[1] // 2:
+            return
+        self._data[:, :-k] = self._data[:, k:]
+        self._data[:, -k:] = numpy.nan
+        self._offset = n
+
+    def update(self, ts, model_obj, se_obj, su_obj, force=False, ts_offset=0):
+        """Plots the rows that are new since the previous frame and draws a frame, if one is due.
+        Only the rows that the estimator can still rewrite are kept, from :attr:`StateEstimator.offset` onwards,
+        so the plotted data is bounded when the model and estimator free their old rows
+
+        Parameters
+        ----------
+        ts : array_like
+            List of times, from the row `ts_offset` onwards
+
+        model_obj : Model.Model
+            Model object
+
+        se_obj : StateEstimator.StateEstimator
+            State estimation object
+
+        su_obj : {stateUpdaters.FakeStateUpdate,  stateUpdaters.LabviewStateUpdate}
+            State updating object
+
+        force : bool, optional
+            If `True` then a frame is drawn even if it is not due yet.
+            Defaults to `False`
+
+        ts_offset : int, optional
+            The index of the row of the first time in `ts`, if the earlier times were dropped.
+            Defaults to zero
+
+        Returns
+        -------
+        drawn : bool
+            `True` if a frame was drawn
+        """
+        now = time.perf_counter()
+        if not force and now - self._last_draw < 1 / self.max_fps:
+            return False
+        self._last_draw = now
+
+        if self._sources is None or self._sources[0] is not model_obj or self._sources[1] is not se_obj:
+            self._sources = (model_obj, se_obj)
+            self._reset()
+
+        # The model and estimator may have freed their oldest rows, see results.ResultWriter
+        model = model_obj.get_data()
+        se = se_obj.get_data()
+        model_offset = model_obj.offset
+        se_offset = se_obj.offset
+        n = model_offset + len(model)
+        self._reserve(n)
+        columns = self._columns
+        data = self._data
+        changed = {}
+
+        # Model rows only ever get appended
+        start = max(self._n_model, self._SKIP, model_offset)
+        if n > start:
+            rows = slice(start - self._offset, n - self._offset)
+            X = model[start - model_offset:]
+            V = X[:, 11]
+            data[columns['t'], rows] = ts[start - ts_offset:n - ts_offset]
+            data[columns['Cg'], rows] = X[:, 0] * 180 / V
+            data[columns['Cfa'], rows] = X[:, 2] * 116 / V
+            data[columns['Ce'], rows] = X[:, 3] * 46 / V
+            data[columns['Cz'], rows] = X[:, 9] / V
+            data[columns['Cy'], rows] = X[:, 10] / V
+            data[columns['T'], rows] = X[:, 13]
+            data[columns['pH'], rows] = X[:, 14]
+            for name in self._MODEL:
+                changed['m_' + name] = start
+        self._n_model = max(n, self._SKIP)
+
+        # Backdated updates rewrite the estimator rows after the time of the update
+        n_se = min(se_offset + len(se), n)
+        start = max(min(self._n_se, se_obj.first_changed(self._se_revision)), self._SKIP, se_offset, model_offset)
+        if n_se > start:
+            rows = slice(start - self._offset, n_se - self._offset)
+            X = se[start - se_offset:n_se - se_offset]
+            # The estimates are scaled by the model volume and the deviations by the estimated volume
+            V_m = model[start - model_offset:n_se - model_offset, 11]
+            V = X[:, 11]
+            K = self._K
+            for name, i, scale in [('Cg', 0, 180), ('Cfa', 2, 116), ('Ce', 3, 46), ('Cz', 9, 1), ('Cy', 10, 1)]:
+                mean = X[:, i] * scale / V_m
+                deviation = X[:, 14 + i] * scale / V * K
+                data[columns[name + '+'], rows] = mean + deviation
+                data[columns[name + '-'], rows] = mean - deviation
+            data[columns['T+'], rows] = X[:, 13] + X[:, 14 + 13]
+            data[columns['T-'], rows] = X[:, 13] - X[:, 14 + 13]
+            for name in self._SE:
+                changed[name] = start
+        self._n_se = max(n_se, self._SKIP)
+        self._se_revision = se_obj.revision
+
+        for name, start in changed.items():
+            column = name[2:] if name.startswith('m_') else name
+            n_line = self._n_model if name.startswith('m_') else self._n_se
+            downsampler = self._downsamplers[name]
+            # Rows that were freed are left out of the bucket that they fell in
+            first = max(downsampler.rewind(start - self._SKIP) + self._SKIP, self._offset)
+            t = data[columns['t'], first - self._offset:n_line - self._offset]
+            y = data[columns[column], first - self._offset:n_line - self._offset]
+            downsampler.extend(t, y, first - self._SKIP)
+            self._lines[name].set_data(*downsampler.points())
+            self._extend_limits(self._lines[name].axes, t[start - first:], y[start - first:])
+        self._discard(min(self._n_model, self._n_se, se_offset))
+
+        # There are few measurements, so they are replotted whenever one is added
+        ts_meas = numpy.asarray(su_obj.get_times())
+        ts_meas = ts_meas[ts_meas <= ts[n - 1 - ts_offset]]
+        if len(ts_meas) != self._n_meas:
+            self._n_meas = len(ts_meas)
+            su = numpy.asarray(su_obj.get_data())
+            for i, name in enumerate(['Cg', 'Cfa', 'Ce']):
+                line = self._lines['meas_' + name]
+                line.set_data(ts_meas, su[:len(ts_meas), i])
+                self._extend_limits(line.axes, ts_meas, su[:len(ts_meas), i])
+
+        self.figure.canvas.draw_idle()
+        self.figure.canvas.flush_events()
+        self.frames += 1
+        return True
+
+    def _extend_limits(self, ax, x, y):
+        """Widens the limits of an axis if new data falls outside of them.
+        The limits are widened by a quarter of their range more than needed,
+        so that they change rarely as the data grows"""
+        x = x[numpy.isfinite(x)]
+        y = y[numpy.isfinite(y)]
+        if not len(x) or not len(y):
+            return
+
+        limits = self._limits[ax]
+        x_min, x_max, y_min, y_max = x.min(), x.max(), y.min(), y.max()
+        if x_min < limits[0] or x_max > limits[1]:
+            low, high = min(x_min, limits[0]), max(x_max, limits[1])
+            margin = 0.25 * (high - low) or 1.
+            limits[0:2] = low if low >= limits[0] else low - margin, high if high <= limits[1] else high + margin
+            ax.set_xlim(limits[0], limits[1])
+        if y_min < limits[2] or y_max > limits[3]:
+            low, high = min(y_min, limits[2]), max(y_max, limits[3])
+            margin = 0.25 * (high - low) or 1.
+            limits[2:4] = low if low >= limits[2] else low - margin, high if high <= limits[3] else high + margin
+            ax.set_ylim(limits[2], limits[3])
+
+
+# The live plot that plot_live draws in
+_live_plot = None
+
+
 def plot_live(ts,
               model_obj: Model.Model,
               se_obj: StateEstimator.StateEstimator,
               su_obj: {stateUpdaters.FakeStateUpdate, stateUpdaters.LabviewStateUpdate},
               confidence=0.95):
-    """
+    """Updates a :class:`LivePlot` in the current figure, which is created on the first call
+
     Parameters
     ----------
     ts : array_like
@@ -144,101 +428,10 @@ def plot_live(ts,
         The confidence probability for the plots
         Defaults to 95%
     """
-    model = model_obj.get_data()
-    se = se_obj.get_data()
-    if model.shape[0] > 3:
-        model = model[3:]
-        se = se[3:]
-    su = su_obj.get_data()
-
-    # Model
-    # 'ts', 'Ng', 'Nx', 'Nfa', 'Ne', 'Nco', 'No', 'Nn', 'Na', 'Nb', 'Nz', 'Ny', 'V', 'Vg', 'T', 'pH'
-    Vs_m = model[:, 11]
-    Cgs_m = model[:, 0] * 180 / Vs_m
-    Cfas_m = model[:, 2] * 116 / Vs_m
-    Ces_m = model[:, 3] * 46 / Vs_m
-    Czs_m = model[:, 9] / Vs_m
-    Cys_m = model[:, 10] / Vs_m
-    Ts_m = model[:, 13]
-    pH_m = model[:, 14]
-    ts_m = ts[:len(Vs_m)]
-
-    # SE means
-    Vs = se[:, 11]
-    Cgs = se[:, 0] * 180 / Vs_m
-    Cfas = se[:, 2] * 116 / Vs_m
-    Ces = se[:, 3] * 46 / Vs_m
-    Czs = se[:, 9] / Vs_m
-    Cys = se[:, 10] / Vs_m
-    Ts = se[:, 13]
-    ts = ts_m
-
-    # Standard deviation multiplier to get the correct confidence interval
-    K = scipy.stats.norm.ppf(confidence)
-    # SE covs
-    Pgs = se[:, 14 + 0] * 180 / Vs * K
-    Pfas = se[:, 14 + 2] * 116 / Vs * K
-    Pes = se[:, 14 + 3] * 46 / Vs * K
-    Pzs = se[:, 14 + 9] / Vs * K
-    Pys = se[:, 14 + 10] / Vs * K
-    PTs = se[:, 14 + 13]
-
-    # Measured update values
-    ts_meas = su_obj.get_times()
-    ts_meas = ts_meas[ts_meas <= ts[-1]]
-    Cg_meas = su[:, 0][:len(ts_meas)]
-    Cfa_meas = su[:, 1][:len(ts_meas)]
-    Ce_meas = su[:, 2][:len(ts_meas)]
-
-    plt.subplot(3, 2, 1)
-    plt.cla()
-    plt.plot(ts_m, Cgs_m, "--")
-    plt.plot(ts, Cgs + Pgs)
-    plt.plot(ts, Cgs - Pgs)
-    plt.plot(ts_meas, Cg_meas, '.')
-    plt.title("Glucose")
-
-    plt.subplot(3, 2, 2)
-    plt.cla()
-    plt.plot(ts_m, Cfas_m, "--")
-    plt.plot(ts, Cfas + Pfas)
-    plt.plot(ts, Cfas - Pfas)
-    plt.plot(ts_meas, Cfa_meas, '.')
-    plt.title("Fumaric")
-
-    plt.subplot(3, 2, 3)
-    plt.cla()
-    plt.plot(ts_m, Ces_m, "--")
-    plt.plot(ts, Ces + Pes)
-    plt.plot(ts, Ces - Pes)
-    plt.plot(ts_meas, Ce_meas, '.')
-    plt.title("Ethanol")
-
-    plt.subplot(3, 2, 4)
-    plt.cla()
-    plt.plot(ts_m, Czs_m, "--")
-    plt.plot(ts, Czs + Pzs, label="Z+")
-    plt.plot(ts, Czs - Pzs, label="Z-")
-
-    plt.plot(ts_m, Cys_m, "--")
-    plt.plot(ts, Cys + Pys, label="Y+")
-    plt.plot(ts, Cys - Pys, label="Y-")
-    plt.title("Enzyme")
-    plt.legend()
-
-    plt.subplot(3, 2, 5)
-    plt.cla()
-    plt.plot(ts_m, Ts_m, "--")
-    plt.plot(ts, Ts + PTs)
-    plt.plot(ts, Ts - PTs)
-    plt.title("Temperature")
-
-    plt.subplot(3, 2, 6)
-    plt.cla()
-    plt.plot(ts_m, pH_m)
-    plt.title("pH")
-
-    plt.pause(0.001)
+    global _live_plot
+    if _live_plot is None or _live_plot.figure is not plt.gcf() or _live_plot.confidence != confidence:
+        _live_plot = LivePlot(confidence)
+    _live_plot.update(ts, model_obj, se_obj, su_obj)
 
 
 def plot_data(file_name, show=True):
@@ -247,15 +440,14 @@ def plot_data(file_name, show=True):
     Parameters
     ----------
     file_name : string
-        The name of the file in which all the data is stored
+        The name of the file in which all the data is stored, see :func:`results.load`
 
     show : bool, optional
         If `True` then the plt.show method is called at the end.
         Useful to turn off when you want to add additional things
         Defaults to `True`
     """
-    xls = pandas.ExcelFile(file_name)
-    su = pandas.read_excel(xls, 'su')
+    su = results.load(file_name)['su']
 
     # Measured update values
     ts_meas = su['ts']
@@ -288,17 +480,17 @@ def plot_model(file_name,  show=True):
     Parameters
     ----------
     file_name : string
-        The name of the file in which all the data is stored
+        The name of the file in which all the data is stored, see :func:`results.load`
 
     show : bool, optional
         If `True` then the plt.show method is called at the end.
         Useful to turn off when you want to add additional things
         Defaults to `True`
     """
-    xls = pandas.ExcelFile(file_name)
-    model = pandas.read_excel(xls, 'model')
-    se = pandas.read_excel(xls, 'se')
-    su = pandas.read_excel(xls, 'su')
+    sections = results.load(file_name)
+    model = sections['model']
+    se = sections['se']
+    su = sections['su']
 
     # Model
     ts_m = model['ts']
@@ -347,4 +539,4 @@ def plot_model(file_name,  show=True):
 
 
 if __name__ == "__main__":
-    plot_all('results/result.xlsx')
+    plot_all('results/result')
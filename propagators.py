@@ -0,0 +1,208 @@
+# Contains the objects that propagate sigma points through the state transition function
+import multiprocessing
+import numpy
+
+
+class SerialPropagator:
+    """Propagates all the sigma points in the current process.
+    The state transition function is called once with all the points stacked
+
+    Parameters
+    ----------
+    fx : callable
+        The state transition function.
+        Must take in an array of states with one state per row and a time step
+
+    Attributes
+    ----------
+    fx : callable
+        The state transition function
+    """
+    def __init__(self, fx):
+        self.fx = fx
+
+    def __call__(self, sigmas, dt, out):
+        """Propagates the sigma points
+
+        Parameters
+        ----------
+        sigmas : 2d array_like
+            The sigma points, one per row
+
+        dt : float
+            The time step
+
+        out : 2d array_like
+            The array in which the propagated sigma points are stored
+        """
+        out[:] = self.fx(sigmas, dt)
+
+    def close(self):
+        """Releases any resources held by the propagator"""
+        pass
+
+
+class PoolPropagator:
+    """Propagates the sigma points in a persistent pool of worker processes.
+    The points are exchanged through shared memory buffers and each worker propagates its own contiguous block of them.
+    The state transition function, including its inputs, is sent to the workers once, when they start.
+    Each propagation only sends the start time `fx.t`, the time step and any inputs received since the previous one,
+    which are passed to the `update` method of the workers' copies of `fx.inputs`, as for
+    :class:`inputters.LabviewInputs`.
+    Results are identical to those of :class:`SerialPropagator`.
+    A block of points costs almost as much to propagate as all of them, because the model equations are batched,
+    so the pool only lowers the latency when there are spare CPUs and `fx` does a lot of work per point
+
+    Parameters
+    ----------
+    fx : callable
+        The state transition function.
+        Must take in an array of states with one state per row and a time step,
+        must have the start time of the propagation as its attribute `t`, and must be picklable
+
+    n_points : int
+        The number of sigma points
+
+    n_states : int
+        The number of states
+
+    workers : int, optional
+        The number of worker processes.
+        Defaults to the number of CPUs
+
+    Attributes
+    ----------
+    fx : callable
+        The state transition function
+
+    workers : int
+        The number of worker processes
+    """
+    def __init__(self, fx, n_points, n_states, workers=None):
+        self.fx = fx
+        self.workers = min(workers or multiprocessing.cpu_count(), n_points)
+
+        shape = (n_points, n_states)
+        self._inputs = multiprocessing.RawArray('d', n_points * n_states)
+        self._outputs = multiprocessing.RawArray('d', n_points * n_states)
+        self._in = numpy.frombuffer(self._inputs).reshape(shape)
+        self._out = numpy.frombuffer(self._outputs).reshape(shape)
+        self._sent = self._n_inputs()
+
+        bounds = numpy.linspace(0, n_points, self.workers + 1).astype(int)
+        self._connections = []
+        self._processes = []
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            connection, worker_connection = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_work, daemon=True,
+                                              args=(worker_connection, fx, self._inputs, self._outputs,
+                                                    shape, start, stop))
+            process.start()
+            worker_connection.close()
+            self._connections.append(connection)
+            self._processes.append(process)
+
+    def _n_inputs(self):
+        """The number of inputs received by `fx.inputs`, or 0 if it does not receive inputs"""
+        inputs = getattr(self.fx, 'inputs', None)
+        return len(inputs.ts) if hasattr(inputs, 'update') else 0
+
+    def _new_inputs(self):
+        """The `(t, data)` pairs of the inputs received since they were last sent to the workers"""
+        n = self._n_inputs()
+        if n == self._sent:
+            return []
+        inputs = self.fx.inputs
+        new = list(zip(inputs.ts[self._sent:n].tolist(), numpy.array(inputs.inputs[self._sent:n])))
+        self._sent = n
+        return new
+
+    def __call__(self, sigmas, dt, out):
+        """Propagates the sigma points
+
+        Parameters
+        ----------
+        sigmas : 2d array_like
+            The sigma points, one per row
+
+        dt : float
+            The time step
+
+        out : 2d array_like
+            The array in which the propagated sigma points are stored
+        """
+        self._in[:] = sigmas
+        message = (self.fx.t, dt, self._new_inputs())
+        for connection in self._connections:
+            connection.send(message)
+        errors = [connection.recv() for connection in self._connections]
+        for error in errors:
+            if error is not None:
+                raise error
+        out[:] = self._out
+
+    def close(self):
+        """Shuts down the worker processes"""
+        for connection in self._connections:
+            connection.send(None)
+            connection.close()
+        for process in self._processes:
+            process.join()
+        self._connections = []
+        self._processes = []
+
+
+class TimedPropagator:
+    """Wraps a propagator and records the duration of every propagation
+
+    Parameters
+    ----------
+    propagator : {SerialPropagator, PoolPropagator}
+        The propagator that does the work
+
+    timer : timing.LatencyTimer
+        Records the durations
+
+    phase : string, optional
+        The name under which the durations are recorded.
+        Defaults to `'propagation'`
+
+    Attributes
+    ----------
+    propagator : {SerialPropagator, PoolPropagator}
+        The propagator that does the work
+    """
+    def __init__(self, propagator, timer, phase='propagation'):
+        self.propagator = propagator
+        self._phase = timer.phase(phase)
+
+    def __call__(self, sigmas, dt, out):
+        """Propagates the sigma points, see :meth:`SerialPropagator.__call__`"""
+        with self._phase:
+            self.propagator(sigmas, dt, out)
+
+    def close(self):
+        """Releases any resources held by the wrapped propagator"""
+        self.propagator.close()
+
+
+def _work(connection, fx, inputs, outputs, shape, start, stop):
+    """Propagates rows `start` to `stop` of the shared buffers whenever the parent process asks,
+    until it sends `None`"""
+    sigmas = numpy.frombuffer(inputs).reshape(shape)[start:stop]
+    out = numpy.frombuffer(outputs).reshape(shape)[start:stop]
+    while True:
+        message = connection.recv()
+        if message is None:
+            break
+
+        fx.t, dt, new_inputs = message
+        for t, data in new_inputs:
+            fx.inputs.update(t, data)
+        try:
+            out[:] = fx(sigmas, dt)
+        except Exception as error:
+            connection.send(error)
+        else:
+            connection.send(None)
+    connection.close()
@@ -0,0 +1,277 @@
+# Contains the storage of the results of a run
+import json
+import os
+import time
+import numpy
+import pandas
+
+MODEL_NAMES = ['Ng', 'Nx', 'Nfa', 'Ne', 'Nco', 'No', 'Nn', 'Na', 'Nb', 'Nz', 'Ny', 'V', 'Vg', 'T', 'pH']
+"""The columns of the model section"""
+
+SE_NAMES = [name + add for add in ['', '_cov'] for name in MODEL_NAMES[:-1]]
+"""The columns of the state estimator section"""
+
+SU_NAMES = ['Cg', 'Cfa', 'Ce']
+"""The columns of the state updater section"""
+
+COLUMNS = {'model': MODEL_NAMES, 'se': SE_NAMES, 'su': SU_NAMES}
+"""The columns of each section, by name"""
+
+VERSION = 1
+
+CONSOLIDATED_FILE = 'results.npz'
+"""The columnar file that a :class:`ResultWriter` leaves in its directory when it is closed"""
+
+
+def write(file_name, sections):
+    """Writes sections of time stamped rows to a columnar file.
+    Each section is stored column by column in a single array whose first row holds the time stamps,
+    and a JSON header records the column names of each section.
+    The file is written under a temporary name and then renamed, so it is never left half written
+
+    Parameters
+    ----------
+    file_name : string
+        The name of the `.npz` file
+
+    sections : dict
+        An array for each section in :data:`COLUMNS` by name, with one row per time stamp
+        and the time stamps in the first column, as returned by :func:`read_stream`
+    """
+    arrays = {}
+    header = dict(version=VERSION, sections={})
+    for name, rows in sections.items():
+        rows = numpy.asarray(rows, dtype=float).reshape(-1, 1 + len(COLUMNS[name]))
+        arrays[name] = numpy.ascontiguousarray(rows.T)
+        header['sections'][name] = dict(columns=COLUMNS[name], rows=len(rows))
+    arrays['header'] = numpy.array(json.dumps(header))
+
+    temporary = '{}.{}.npz'.format(os.path.splitext(file_name)[0], os.getpid())
+    numpy.savez(temporary, **arrays)
+    os.replace(temporary, file_name)
+
+
+def load(file_name):
+    """Loads the results of a run
+
+    Parameters
+    ----------
+    file_name : string
+        The directory of a :class:`ResultWriter`, or a `.npz` file written by :func:`write`.
+        A directory that is still being written can be read, and holds the rows up to its last flush.
+        Excel files written by earlier versions of the simulation are also read
+
+    Returns
+    -------
+    sections : dict
+        A data frame for each section by name, with a `'ts'` column followed by the columns in :data:`COLUMNS`
+    """
+    if os.path.isdir(file_name):
+        consolidated = os.path.join(file_name, CONSOLIDATED_FILE)
+        if not os.path.exists(consolidated):
+            return {name: pandas.DataFrame(rows, columns=['ts'] + COLUMNS[name])
+                    for name, rows in read_stream(file_name).items()}
+        file_name = consolidated
+
+    if file_name.endswith('.xlsx'):
+        xls = pandas.ExcelFile(file_name)
+        return {name: pandas.read_excel(xls, name) for name in xls.sheet_names}
+
+    with numpy.load(file_name) as f:
+        header = json.loads(str(f['header']))
+        sections = {}
+        for name, section in header['sections'].items():
+            sections[name] = pandas.DataFrame(f[name].T, columns=['ts'] + section['columns'])
+    return sections
+
+
+def read_stream(path):
+    """Reads the rows that a :class:`ResultWriter` has written so far.
+    A record that was cut off by a crash is ignored,
+    and where a row was written more than once its last version is used
+
+    Parameters
+    ----------
+    path : string
+        The directory of the writer
+
+    Returns
+    -------
+    sections : dict
+        An array for each section by name, with the time stamps in the first column
+    """
+    with open(os.path.join(path, 'header.json')) as f:
+        header = json.load(f)
+
+    sections = {}
+    for name, section in header['sections'].items():
+        width = 2 + len(section['columns'])
+        records = numpy.fromfile(os.path.join(path, name + '.bin'))
+        records = records[:len(records) // width * width].reshape(-1, width)
+        indices = records[:, 0].astype(int)
+
+        # The last record of each row is the first one in the reversed records
+        rows, first = numpy.unique(indices[::-1], return_index=True)
+        data = numpy.full((rows[-1] + 1 if len(rows) else 0, width - 1), numpy.nan)
+        data[rows] = records[len(records) - 1 - first, 1:]
+        sections[name] = data
+    return sections
+
+
+class ResultWriter:
+    """Streams the results of a run to disk as the run progresses.
+    Rows are gathered from the model, state estimator and state updater when a flush is due,
+    appended to one file per section and synced to disk, so a crash loses at most the rows since the last flush.
+    Each record holds the index of its row, so estimator rows that a backdated update rewrote are appended again,
+    and readers use the last version of each row, see :func:`read_stream`.
+    When the writer is closed, the rows are consolidated into a columnar file, see :meth:`close`.
+    With `keep_rows`, the model and state estimator only keep their most recent rows in memory once they are written
+
+    Parameters
+    ----------
+    path : string
+        The directory to write to.
+        It is created if needed, and results already in it are overwritten
+
+    model_obj : Model.Model
+        The model, with `pH_calculations` turned on
+
+    se_obj : StateEstimator.StateEstimator
+        The state estimator
+
+    su_obj : {stateUpdaters.FakeStateUpdate, stateUpdaters.LabviewStateUpdate}
+        The state updater
+
+    interval : float, optional
+        The time in seconds between flushes made by :meth:`step`.
+        Defaults to 10
+
+    keep_rows : int, optional
+        If given, after each flush the rows of the model and state estimator that were written,
+        except the last `keep_rows`, are freed, see :meth:`Model.Model.discard`
+        and :meth:`StateEstimator.StateEstimator.discard`.
+        Rows that a backdated update rewrote are kept until the flush after the one that wrote them,
+        so readers should poll the estimator more often than every `interval`.
+        The model keeps the rows that the estimator keeps, as its volumes are needed to plot the estimates.
+        Defaults to `None`, which keeps every row in memory
+
+    Attributes
+    ----------
+    path : string
+        The directory written to
+
+    interval : float
+        The time in seconds between flushes
+
+    keep_rows : int
+        The number of written rows that are kept in memory
+
+    rows : dict
+        The number of rows of each section that have been written, by name
+    """
+    def __init__(self, path, model_obj, se_obj, su_obj, interval=10., keep_rows=None):
+        self.path = path
+        self.interval = interval
+        self.keep_rows = keep_rows
+        self._model = model_obj
+        self._se = se_obj
+        self._su = su_obj
+        self._se_revision = se_obj.revision
+        self._last_flush = time.monotonic()
+
+        os.makedirs(path, exist_ok=True)
+        # A consolidated file left by an earlier run would be read instead of the rows of this one
+        consolidated = os.path.join(path, CONSOLIDATED_FILE)
+        if os.path.exists(consolidated):
+            os.remove(consolidated)
+        header = dict(version=VERSION, sections={name: dict(columns=columns) for name, columns in COLUMNS.items()})
+        temporary = os.path.join(path, 'header.{}.json'.format(os.getpid()))
+        with open(temporary, 'w') as f:
+            json.dump(header, f)
+        os.replace(temporary, os.path.join(path, 'header.json'))
+
+        self.rows = {name: 0 for name in COLUMNS}
+        self._files = {name: open(os.path.join(path, name + '.bin'), 'wb') for name in COLUMNS}
+
+    def step(self):
+        """Flushes the new rows if `interval` has passed since the previous flush
+
+        Returns
+        -------
+        flushed : bool
+            `True` if the rows were flushed
+        """
+        if time.monotonic() - self._last_flush < self.interval:
+            return False
+        self.flush()
+        return True
+
+    def flush(self):
+        """Appends the rows that are new or rewritten since the previous flush to disk and syncs the files"""
+        self._last_flush = time.monotonic()
+
+        model = self._model.get_data()
+        self._write('model', self.rows['model'], self._model.get_ts(), model, self._model.offset)
+
+        se = self._se.get_data()
+        start = min(self.rows['se'], self._se.first_changed(self._se_revision))
+        self._se_revision = self._se.revision
+        self._write('se', start, self._se.ts, se, self._se.offset)
+
+        ts_meas = numpy.asarray(self._su.get_times(), dtype=float)
+        su = numpy.asarray(self._su.get_data(), dtype=float).reshape(len(ts_meas), len(SU_NAMES))
+        self._write('su', self.rows['su'], ts_meas, su)
+
+        for f in self._files.values():
+            f.flush()
+            os.fsync(f.fileno())
+
+        if self.keep_rows is not None:
+            # The rows rewritten by this flush stay in memory until the next one,
+            # so that readers that poll more often than `interval` see their last version
+            self._se.discard(min(self.rows['se'] - self.keep_rows, start))
+            self._model.discard(min(self.rows['model'] - self.keep_rows, self._se.offset))
+
+    def _write(self, name, start, ts, data, offset=0):
+        """Appends the rows of a section from index `start` onwards,
+        where `ts` and `data` hold the rows from index `offset` onwards"""
+        n = offset + len(data)
+        if n <= start:
+            return
+
+        records = numpy.empty((n - start, 2 + data.shape[1]))
+        records[:, 0] = numpy.arange(start, n)
+        records[:, 1] = ts[start - offset:]
+        records[:, 2:] = data[start - offset:]
+        records.tofile(self._files[name])
+        self.rows[name] = n
+
+    def close(self):
+        """Flushes the remaining rows and closes the files.
+        The last version of every row is then written to :data:`CONSOLIDATED_FILE` with :func:`write`,
+        after which the streamed files are removed
+        """
+        self.flush()
+        for f in self._files.values():
+            f.close()
+
+        write(os.path.join(self.path, CONSOLIDATED_FILE), read_stream(self.path))
+        for name in COLUMNS:
+            os.remove(os.path.join(self.path, name + '.bin'))
+        os.remove(os.path.join(self.path, 'header.json'))
+
+
+def to_excel(file_name, excel_file_name):
+    """Converts results to an Excel workbook with one sheet per section
+
+    Parameters
+    ----------
+    file_name : string
+        The directory of a :class:`ResultWriter`, or any other file that :func:`load` reads
+
+    excel_file_name : string
+        The name of the `.xlsx` file
+    """
+    with pandas.ExcelWriter(excel_file_name, engine='xlsxwriter') as xls:
+        for name, section in load(file_name).items():
+            section.to_excel(xls, sheet_name=name, index=False)
@@ -0,0 +1,136 @@
+# Contains the objects that decide the interval that a state estimator prediction covers
+
+
+class FixedScheduler:
+    """Predicts over a fixed period, starting at the time of the step that triggers the prediction.
+    A prediction is due at the first step after the previous prediction period has ended,
+    so the time between the end of one period and that step is not propagated
+
+    Parameters
+    ----------
+    period : float
+        The length of each prediction
+
+    Attributes
+    ----------
+    period : float
+        The length of each prediction
+    """
+    def __init__(self, period):
+        self.period = period
+
+    def first_predict(self, t):
+        """The time after which the first prediction is due
+
+        Parameters
+        ----------
+        t : float
+            The time of the initial estimate
+        """
+        return t
+
+    def interval(self, t, t_next_predict):
+        """The interval of the prediction that is due at time `t`
+
+        Parameters
+        ----------
+        t : float
+            The current time
+
+        t_next_predict : float
+            The time after which the prediction became due
+
+        Returns
+        -------
+        t_start : float
+            The time from which to predict
+
+        dt : float
+            The length of the prediction
+        """
+        return t, self.period
+
+    def next_predict(self, t_start, dt):
+        """The time after which the next prediction is due
+
+        Parameters
+        ----------
+        t_start, dt : float
+            The interval of the prediction that was just made
+        """
+        return t_start + dt
+
+
+class ElapsedScheduler:
+    """Predicts over the time that has actually passed since the end of the previous prediction.
+    A prediction is due at the first step more than `period` after the end of the previous prediction,
+    so the prediction cadence does not depend on the rate at which the estimator is stepped.
+    All the periods that passed since the last prediction are coalesced into a single propagation.
+    If `max_interval` is given, a prediction never covers more than that,
+    which bounds the work done in a step; the remainder is caught up by the following steps
+
+    Parameters
+    ----------
+    period : float
+        The time between predictions
+
+    max_interval : float, optional
+        The longest interval that a single prediction covers.
+        Defaults to `None`, which means there is no limit
+
+    Attributes
+    ----------
+    period : float
+        The time between predictions
+
+    max_interval : float
+        The longest interval that a single prediction covers
+    """
+    def __init__(self, period, max_interval=None):
+        self.period = period
+        self.max_interval = max_interval
+
+    def first_predict(self, t):
+        """The time after which the first prediction is due
+
+        Parameters
+        ----------
+        t : float
+            The time of the initial estimate
+        """
+        return t + self.period
+
+    def interval(self, t, t_next_predict):
+        """The interval of the prediction that is due at time `t`
+
+        Parameters
+        ----------
+        t : float
+            The current time
+
+        t_next_predict : float
+            The time after which the prediction became due
+
+        Returns
+        -------
+        t_start : float
+            The time from which to predict
+
+        dt : float
+            The length of the prediction
+        """
+        t_start = t_next_predict - self.period
+        dt = t - t_start
+        if self.max_interval is not None:
+            dt = min(dt, self.max_interval)
+        return t_start, dt
+
+    def next_predict(self, t_start, dt):
+        """The time after which the next prediction is due
+
+        Parameters
+        ----------
+        t_start, dt : float
+            The interval of the prediction that was just made
+        """
+        return t_start + dt + self.period
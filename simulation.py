@@ -1,4 +1,3 @@
-import pandas
 import numpy
 from Model import Model
 import StateEstimator
@@ -6,6 +5,7 @@ import inputters
 import stateUpdaters
 import tqdm
 import plotting
+import results
 import matplotlib.pyplot as plt
 
 backdate = 0
@@ -26,6 +26,10 @@ t_predict = 1
 se = StateEstimator.StateEstimator(X0, inputs, t_predict)
 
 live_plot = False
+export_excel = False
+
+# Results are streamed to disk as the run progresses
+writer = results.ResultWriter('results/result', m, se, su)
 
 if live_plot:
     plt.figure(figsize=(20, 20))
@@ -39,30 +43,16 @@ for ti in tqdm.tqdm(ts[1:]):
         z = su.get_update()
         se.update(z, ti-backdate if backdate else numpy.nan)
 
+    writer.step()
+
     if live_plot:
         plotting.plot_live(ts, m, se, su)
 
 if live_plot:
     plt.ioff()
 
-Xs = se.get_Xs()
-xls = pandas.ExcelWriter('results/result.xlsx', engine='xlsxwriter')
-
-model_names = ['Ng', 'Nx', 'Nfa', 'Ne', 'Nco', 'No', 'Nn', 'Na', 'Nb', 'Nz', 'Ny', 'V', 'Vg', 'T', 'pH']
-model_data = pandas.DataFrame(m.get_data(), index=ts, columns=model_names)
-model_data.index.name = 'ts'
-model_data.to_excel(xls, 'model')
-
-se_names = [name + add for add in ['', '_cov'] for name in model_names[:-1]]
-se_data = pandas.DataFrame(se.get_data(), index=ts, columns=se_names)
-se_data.index.name = 'ts'
-se_data.to_excel(xls, 'se')
-
-su_names = ['Cg', 'Cfa', 'Ce']
-su_data = pandas.DataFrame(su.get_data(), index=su.get_times(), columns=su_names)
-su_data.index.name = 'ts'
-su_data.to_excel(xls, 'su')
-
-xls.save()
+writer.close()
+if export_excel:
+    results.to_excel('results/result', 'results/result.xlsx')
 
-plotting.plot_all('results/result.xlsx')
+plotting.plot_all('results/result')
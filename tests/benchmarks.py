@@ -0,0 +1,318 @@
+# Times the simulation and estimation hot paths on the run 9 data,
+# after checking that the batched model equations match the scalar ones exactly.
+# Run from the repository root:
+#     python tests/benchmarks.py --output before.json
+#     python tests/benchmarks.py --compare before.json
+import argparse
+import atexit
+import json
+import os
+import platform
+import subprocess
+import sys
+import timeit
+import matplotlib
+import numpy
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+matplotlib.use('Agg')
+
+import matplotlib.pyplot as plt  # noqa: E402
+import Model  # noqa: E402
+import StateEstimator  # noqa: E402
+import inputters  # noqa: E402
+import plotting  # noqa: E402
+import propagators  # noqa: E402
+import stateUpdaters  # noqa: E402
+
+GLUCOSE_FILE = os.path.join(ROOT, 'data', 'run_9_glucose.csv')
+CONC_FILE = os.path.join(ROOT, 'data', 'run_9_conc.csv')
+
+# Biomass C H_1.8 O_0.5 N_0.2 => 24.6 g/mol
+#     Ng, Nx, Nfa, Ne, Nco, No, Nn, Na, Nb, Nz, Ny, V, Vg, T
+X0 = [0, 4.6/24.6, 0, 0, 0, 0, 0, 1e-5, 0, 5.1, 1.2, 1.077, 0.1, 25]
+
+DT = 0.1
+T_PREDICT = 1
+HISTORY_STEPS = 2000
+BACKDATE = 2
+LONG_PREDICT = 20
+
+
+def fixtures(method='ukf'):
+    """Runs the model and the state estimator over the first part of run 9,
+    so that the benchmarks start from realistic states and history lengths"""
+    inputs = inputters.FakeInputs(GLUCOSE_FILE)
+    su = stateUpdaters.FakeStateUpdate(CONC_FILE, backdate=BACKDATE)
+    m = Model.Model(X0, inputs, pH_calculations=True)
+    se = StateEstimator.StateEstimator(X0, inputs, T_PREDICT, method=method)
+
+    ts = [0.]
+    for _ in range(HISTORY_STEPS):
+        ts.append(ts[-1] + DT)
+        m.step(DT)
+        se.step(DT)
+        su.step(DT)
+        if su.update_ready():
+            se.update(su.get_update(), ts[-1] - BACKDATE)
+    m.get_pHs()
+    return inputs, su, m, se, numpy.array(ts)
+
+
+def benchmarks():
+    """The benchmarks, as a dict of functions to time by name"""
+    inputs, su, m, se, ts = fixtures()
+    t = ts[-1]
+    z = StateEstimator.StateEstimator.hx(se.ukf.x)
+    sigmas = se.sigmas.sigma_points(se.ukf.x, se.ukf.P)
+
+    def model_step():
+        # The model is copied so that its history does not grow with every repeat
+        model = Model.Model(m.X, inputs, t)
+        for _ in range(100):
+            model.step(DT)
+
+    def ukf_predict():
+        se.fx.t = t
+        se.ukf.predict(T_PREDICT)
+
+    # Each backdated update is logged and redone by the later ones, so the log is reset before every call
+    # to give each call the same starting state
+    updates = list(se._updates)
+
+    def backdated_update():
+        se._updates[:] = updates
+        se.update(z, t - BACKDATE)
+
+    # The EKF is the cheaper alternative to the UKF, so it is timed on the same predicts and updates.
+    # The repeated predicts reuse the linearization of their period, as four in five predicts do
+    _, _, _, ekf_se, _ = fixtures('ekf')
+    ekf_updates = list(ekf_se._updates)
+
+    def ekf_predict():
+        ekf_se.fx.t = t
+        ekf_se.ukf.predict(T_PREDICT)
+
+    def ekf_backdated_update():
+        ekf_se._updates[:] = ekf_updates
+        ekf_se.update(z, t - BACKDATE)
+
+    def first_frame():
+        # A new plot converts and draws every row
+        figure = plt.figure()
+        plotting.LivePlot(figure=figure).update(ts, m, se, su, force=True)
+        plt.close(figure)
+
+    # A plot that has drawn every row only converts the estimator rows that the backdated update rewrote
+    live_plot = plotting.LivePlot(figure=plt.figure())
+    live_plot.update(ts, m, se, su, force=True)
+
+    def backdated_frame():
+        se._updates[:] = updates
+        se.update(z, t - BACKDATE)
+        live_plot.update(ts, m, se, su, force=True)
+
+    # The pool is compared with the serial propagator over a long prediction period, where each point needs
+    # many substeps. The workers run in parallel, so the pool can only be faster with several CPUs
+    propagated = numpy.empty_like(sigmas)
+    serial = propagators.SerialPropagator(se.fx)
+    pool = propagators.PoolPropagator(se.fx, len(sigmas), se.nx, workers=2)
+    atexit.register(pool.close)
+
+    return {
+        'Model.DEs': lambda: m.DEs(t),
+        'Model.step (x100)': model_step,
+        'Model.calculate_pH': m.calculate_pH,
+        'StateEstimator.FXObj.__call__': lambda: se.fx(sigmas, T_PREDICT),
+        'SerialPropagator': lambda: serial(sigmas, LONG_PREDICT, propagated),
+        'PoolPropagator (2 workers)': lambda: pool(sigmas, LONG_PREDICT, propagated),
+        'ukf.predict': ukf_predict,
+        'ukf.update': lambda: se.ukf.update(z),
+        'StateEstimator.update (backdated)': backdated_update,
+        'ekf.predict': ekf_predict,
+        'StateEstimator.update (backdated, ekf)': ekf_backdated_update,
+        'FakeInputs.__call__': lambda: inputs(t),
+        'LivePlot.update (first frame)': first_frame,
+        'LivePlot.update (backdated)': backdated_frame,
+    }
+
+
+def backdated_estimates(storage, method):
+    """Runs the state estimator with updates backdated into the first checkpoint interval and to before the start,
+    so that both roll back to the initial row
+
+    Returns
+    -------
+    data : 2d array_like
+        The estimates and deviations of every row
+    """
+    inputs = inputters.FakeInputs(GLUCOSE_FILE)
+    se = StateEstimator.StateEstimator(X0, inputs, T_PREDICT, covariance_storage=storage,
+                                       checkpoint_interval=50, method=method)
+    t = 0.
+    for i in range(100):
+        t += DT
+        se.step(DT)
+        if i == 40:
+            se.update(se.hx(se.ukf.x) * 1.1, t - 2.5)
+        if i == 70:
+            se.update(se.hx(se.ukf.x) * 0.9, t - 100)
+    return numpy.array(se.get_data())
+
+
+def central_differences(f, x, relative_step=1e-6):
+    """Differentiates `f` with respect to the last axis of `x` by central differences
+
+    Returns
+    -------
+    derivatives : array_like
+        The derivatives, with the output axes followed by the last axis of `x`
+    """
+    steps = relative_step * numpy.maximum(abs(x), 1e-3)
+    columns = []
+    for j in range(x.shape[-1]):
+        step = numpy.zeros_like(x)
+        step[..., j] = steps[..., j]
+        columns.append((f(x + step) - f(x - step)) / (2 * steps[..., j:j + 1]))
+    return numpy.stack(columns, axis=-1)
+
+
+def check():
+    """Checks that the batched model equations give exactly the same rows as the scalar product
+    of the inverse rate matrix, whatever the number of rows, so that speedups do not change results,
+    and that the 'checkpoint' covariance storage gives the same estimates as the 'full' one.
+    Also checks the exact Jacobians of the model against central differences at a few states,
+    where zero states are moved off the kink of the clipping
+
+    Returns
+    -------
+    failures : list
+        The names of the checks that failed
+    """
+    inputs = inputters.FakeInputs(GLUCOSE_FILE)
+    m = Model.Model(X0, inputs)
+    for _ in range(400):
+        m.step(DT)
+    Xs = numpy.array(m.get_Xs())
+    Us = inputs(m.t)
+
+    rate_matrix_inv = Model.CONSTANTS.rate_matrix_inv
+    RHS = numpy.random.RandomState(0).standard_normal((len(Xs), 5)) * 10.**-numpy.arange(5)
+    scalar = numpy.array([rate_matrix_inv[0] @ row for row in RHS])
+
+    batched = Model.batch_DEs(Xs, Us)
+    results = {
+        'rate products': numpy.array_equal(Model._rate_products(rate_matrix_inv, list(RHS.T)).T, scalar),
+        'batch_DEs (rows)': numpy.array_equal(
+            batched, numpy.array([Model.batch_DEs(X[numpy.newaxis], Us)[0] for X in Xs])),
+        'batch_DEs (chunks)': numpy.array_equal(
+            batched, numpy.concatenate([Model.batch_DEs(Xs[i:i + 7], Us) for i in range(0, len(Xs), 7)])),
+    }
+
+    states = numpy.maximum(Xs[[100, 200, 300, 400]], 1e-3)
+    U = numpy.array(Us, dtype=float)
+    dfdX, dfdU = Model.batch_jacobian(states, U)
+    results['batch_jacobian (states)'] = numpy.allclose(
+        central_differences(lambda X: Model.batch_DEs(X, U), states), dfdX, rtol=1e-5, atol=1e-8)
+    results['batch_jacobian (inputs)'] = numpy.allclose(
+        central_differences(lambda u: Model.batch_DEs(states, u), U), dfdU, rtol=1e-5, atol=1e-8)
+    results['batch_jacobian (without inputs)'] = numpy.array_equal(
+        Model.batch_jacobian(states, U, with_inputs=False)[0], dfdX)
+
+    for method in ['ukf', 'srukf', 'ekf']:
+        results['checkpoint storage ({})'.format(method)] = numpy.array_equal(
+            backdated_estimates('checkpoint', method), backdated_estimates('full', method))
+    return [name for name, passed in results.items() if not passed]
+
+
+def run(repeat=5, min_time=0.2):
+    """Times every benchmark
+
+    Parameters
+    ----------
+    repeat : int, optional
+        The number of timing runs of each benchmark
+
+    min_time : float, optional
+        The minimum duration of a timing run in seconds
+
+    Returns
+    -------
+    results : dict
+        The best and median time per call in seconds, and the number of calls per run, by name
+    """
+    results = {}
+    for name, function in benchmarks().items():
+        timer = timeit.Timer(function)
+        number, _ = timer.autorange()
+        number = max(1, int(number * min_time / 0.2))
+        times = numpy.array(timer.repeat(repeat, number)) / number
+        results[name] = dict(best=float(times.min()), median=float(numpy.median(times)), number=number)
+    return results
+
+
+def metadata():
+    """Describes the environment in which the benchmarks ran"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return dict(commit=commit, python=platform.python_version(), numpy=numpy.__version__,
+                machine=platform.machine(), processor=platform.processor())
+
+
+def compare(results, baseline, threshold):
+    """Prints the change of every benchmark relative to a baseline
+
+    Returns
+    -------
+    regressions : list
+        The names of the benchmarks that slowed down by more than `threshold`
+    """
+    regressions = []
+    print('{:40} {:>12} {:>12} {:>8}'.format('benchmark', 'baseline', 'current', 'ratio'))
+    for name, result in results.items():
+        if name not in baseline:
+            print('{:40} {:>12} {:>12.3g}'.format(name, '-', result['best']))
+            continue
+        ratio = result['best'] / baseline[name]['best']
+        flag = ''
+        if ratio > threshold:
+            flag = '  slower'
+            regressions.append(name)
+        print('{:40} {:>12.3g} {:>12.3g} {:>8.2f}{}'.format(name, baseline[name]['best'], result['best'], ratio, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Times the simulation and estimation hot paths')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='compare the results to those in this JSON file')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='the slowdown ratio above which --compare fails (default 1.25)')
+    parser.add_argument('--repeat', type=int, default=5, help='the number of timing runs (default 5)')
+    args = parser.parse_args()
+
+    failures = check()
+    if failures:
+        sys.exit('the results checks failed: ' + ', '.join(failures))
+
+    results = run(args.repeat)
+    report = dict(metadata=metadata(), results=results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+# Contains the latency instrumentation of the real-time loop
+import collections
+import json
+import time
+import numpy
+
+
+class LatencyWindow:
+    """The most recent durations of a phase, kept in a ring buffer
+
+    Parameters
+    ----------
+    size : int
+        The number of durations kept
+
+    Attributes
+    ----------
+    count : int
+        The number of durations recorded since the window was last cleared
+
+    max : float
+        The longest duration recorded since the window was last cleared
+    """
+    def __init__(self, size):
+        self._durations = numpy.zeros(size)
+        self.clear()
+
+    def clear(self):
+        """Forgets all the durations"""
+        self.count = 0
+        self.max = 0.
+
+    def add(self, duration):
+        """Records a duration in seconds"""
+        self._durations[self.count % len(self._durations)] = duration
+        self.count += 1
+        if duration > self.max:
+            self.max = duration
+
+    def durations(self):
+        """The durations in the window, in no particular order"""
+        return self._durations[:min(self.count, len(self._durations))]
+
+    def summary(self):
+        """The latency statistics of the phase
+
+        Returns
+        -------
+        summary : dict
+            The number of calls, the median and 95th percentile of the durations in the window,
+            and the longest duration ever, in seconds
+        """
+        durations = self.durations()
+        if len(durations):
+            p50, p95 = numpy.percentile(durations, [50, 95])
+        else:
+            p50 = p95 = 0.
+        return dict(count=self.count, p50=float(p50), p95=float(p95), max=float(self.max))
+
+
+class _Phase:
+    """Times the body of a `with` statement"""
+    __slots__ = ('window', 'start')
+
+    def __init__(self, window):
+        self.window = window
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.window.add(time.perf_counter() - self.start)
+
+
+class LatencyTimer:
+    """Keeps rolling latency statistics of named phases, and named event counters.
+    Timing a phase costs two clock reads, so it can be left on in the real-time loop.
+    Phases may be nested, in which case the outer phase includes the inner one
+
+    Parameters
+    ----------
+    window : int, optional
+        The number of recent durations of each phase over which percentiles are computed.
+        Defaults to 1000
+
+    Attributes
+    ----------
+    window : int
+        The number of recent durations of each phase that are kept
+
+    phases : dict
+        The :class:`LatencyWindow` of each phase, by name
+
+    counters : collections.Counter
+        The event counts, by name
+
+    Examples
+    --------
+    >>> timer = LatencyTimer()
+    >>> with timer.phase('model_step'):
+    ...     pass
+    >>> timer.count('updates')
+    >>> timer.summary()['counters']['updates']
+    1
+    """
+    def __init__(self, window=1000):
+        self.window = window
+        self.phases = {}
+        self.counters = collections.Counter()
+        self._phases = {}
+
+    def phase(self, name):
+        """A context manager that records the duration of its body under `name`"""
+        try:
+            return self._phases[name]
+        except KeyError:
+            self.phases[name] = LatencyWindow(self.window)
+            self._phases[name] = _Phase(self.phases[name])
+            return self._phases[name]
+
+    def count(self, name, n=1):
+        """Adds `n` to the counter `name`"""
+        self.counters[name] += n
+
+    def reset(self):
+        """Forgets all the durations and counts"""
+        for window in self.phases.values():
+            window.clear()
+        self.counters.clear()
+
+    def summary(self):
+        """The latency statistics of every phase and the value of every counter
+
+        Returns
+        -------
+        summary : dict
+            `'phases'` holds the :meth:`LatencyWindow.summary` of each phase by name,
+            and `'counters'` the value of each counter by name
+        """
+        return dict(phases={name: window.summary() for name, window in self.phases.items()},
+                    counters=dict(self.counters))
+
+    def dump(self, filename):
+        """Writes the :meth:`summary` to a JSON file, along with the raw durations in the windows
+
+        Parameters
+        ----------
+        filename : string
+            The name of the file
+        """
+        report = self.summary()
+        report['time'] = time.time()
+        report['durations'] = {name: window.durations().tolist() for name, window in self.phases.items()}
+        with open(filename, 'w') as f:
+            json.dump(report, f, indent=2)